@@ -1,57 +1,118 @@
+import functools
 import json
 import sqlite3
-import traceback
+import time
+import uuid
+from collections.abc import Callable, Iterator
+from dataclasses import asdict
+from datetime import date
 from urllib.parse import urlparse
 
 import requests
-from flask import Flask, g, render_template, request, send_from_directory
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    render_template,
+    request,
+    send_from_directory,
+)
 
 import app.tiss as tiss
-from app.format import improve_calendar
-from app.monitoring import add_usage, get_chart_data, get_statistics
+from app.database import ConnectionManager, open_database
+from app.format import (
+    BUNDLE_FILE,
+    compile_resources,
+    create_shorthand_report,
+    get_fragment_statistics,
+    read_courses,
+    read_shorthands,
+)
+from app.metrics import SIZE_BUCKETS, Sample, Trace, metrics, to_prometheus, traced
+from app.monitoring import (
+    CHART_RESOLUTIONS,
+    OPEN_DAY_TTL,
+    UsageRecorder,
+    downsample,
+    get_chart_data_since,
+    get_statistics,
+    get_statistics_version,
+    hash_token,
+    statistic,
+)
+from app.pipeline import CalendarOptions, get_cache_statistics, get_rendered_calendar
 
 app = Flask(__name__)
+app.config.update(
+    {
+        # Serve calendars up to this many seconds old while fetching a new
+        # version in the background. None always waits for TISS.
+        "CALENDAR_MAX_STALENESS": None,
+        # A directory used to coalesce fetches of the same calendar across
+        # workers. None only coalesces within a worker.
+        "CALENDAR_COALESCE_DIR": None,
+        "TISS_CALENDAR_URL": "https://tiss.tuwien.ac.at/events/rest/calendar/personal",
+        # A directory in which every worker stores its metrics, so that
+        # /metrics reports all of them. None only reports the serving worker.
+        "METRICS_DIR": None,
+        # Log the stages of every calendar request that takes longer than this
+        # many seconds. None logs nothing.
+        "SLOW_REQUEST_THRESHOLD": None,
+    }
+)
+app.config.from_prefixed_env()
+metrics.directory = app.config["METRICS_DIR"]
+
+
+def cache_samples() -> Iterator[Sample]:
+    for cache, statistics in get_cache_statistics().items():
+        labels = (("cache", cache),)
+        yield ("bettercal_cache_hits_total", labels, statistics.hits)
+        yield ("bettercal_cache_misses_total", labels, statistics.misses)
+
+
+metrics.collectors.append(cache_samples)
 
 DATABASE = "bettercal.db"
 
 
 def create_db() -> sqlite3.Connection:
     if app.config["TESTING"]:
-        db = sqlite3.connect(":memory:")
-    else:
-        db = sqlite3.connect(DATABASE)
-        db.execute("PRAGMA journal_mode=WAL;")
-
-    db.cursor().executescript(
-        """
-        CREATE TABLE IF NOT EXISTS statistics_daily (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT DEFAULT (DATE('now')),
-            token_hash TEXT NOT NULL,
-            UNIQUE(date, token_hash)
-        );
-        """
-    )
-    db.commit()
-    return db
+        return open_database(":memory:")
+    return open_database(DATABASE)
+
+
+# Every thread of a worker keeps its connection open
+connections = ConnectionManager(create_db)
 
 
 def get_db() -> sqlite3.Connection:
-    db = getattr(g, "_database", None)
-    if db is None:
-        db = g._database = create_db()
-    return db
+    return connections.get()
+
+
+# Calendars are polled all the time, so we don't write every request right away.
+usage_recorder = UsageRecorder(connections.get)
+
 
+@app.cli.command("compile-resources")
+def compile_resources_command():
+    """Compile the resources into a single file that loads quickly."""
+    compile_resources()
+    print(f"Compiled resources into {BUNDLE_FILE}")
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, "_database", None)
-    if db is not None:
-        db.close()
 
+@app.cli.command("shorthand-report")
+def shorthand_report_command():
+    """List the lectures that need a shorthand in shorthands.csv."""
+    report = create_shorthand_report(read_courses(), read_shorthands())
 
-# Preheat the statistics cache
-get_chart_data(create_db())
+    print(f"{len(report.collisions)} shorthands are used by multiple lectures:")
+    for shorthand, names in sorted(report.collisions.items()):
+        print(f"  {shorthand}: {', '.join(sorted(names))}")
+
+    print(f"\n{len(report.invalid)} lectures have no valid shorthand:")
+    for name in sorted(report.invalid):
+        print(f"  {name}")
 
 
 @app.route("/")
@@ -59,12 +120,69 @@ def home():
     return render_template("home.html")
 
 
+def statistics_response(render: Callable[[statistic], Response]) -> Response:
+    statistic = get_statistics(get_db())
+
+    # The history only changes once a day, so browsers mostly just revalidate
+    etag = get_statistics_version(get_db(), statistic)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = render(statistic)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = OPEN_DAY_TTL
+    return response
+
+
 @app.route("/statistics")
 def statistic_page():
-    statistic = get_statistics(get_db())
-    chart_data = get_chart_data(get_db())
-    return render_template(
-        "statistics.html", statistic=statistic, chart_data=json.dumps(chart_data)
+    # The chart fetches its data from /statistics/chart
+    return statistics_response(
+        lambda statistic: Response(
+            render_template("statistics.html", statistic=statistic)
+        )
+    )
+
+
+@app.route("/statistics/chart")
+def chart_statistics():
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            since = date.fromisoformat(since).isoformat()
+        except ValueError:
+            return "since must be a date like 2024-01-31", 400
+
+    resolution = request.args.get("resolution", "day")
+    if resolution not in CHART_RESOLUTIONS:
+        return f"resolution must be one of {', '.join(CHART_RESOLUTIONS)}", 400
+
+    return statistics_response(
+        lambda _: jsonify(downsample(get_chart_data_since(get_db(), since), resolution))
+    )
+
+
+@app.route("/statistics/pool")
+def pool_statistics():
+    return asdict(tiss.get_pool_statistics())
+
+
+@app.route("/statistics/usage")
+def usage_statistics():
+    return asdict(usage_recorder.statistics())
+
+
+@app.route("/statistics/fragments")
+def fragment_statistics():
+    return asdict(get_fragment_statistics())
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(
+        to_prometheus(metrics.collect()),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
     )
 
 
@@ -73,16 +191,16 @@ def static_asset(path):
     return send_from_directory("static", path)
 
 
-@app.route("/verify")
-def verify():
-    url = request.args.get("url", "").strip()
-    if url is None or url == "":
-        return "Empty links don't work *surprised picatchu meme*", 400
+def validate_calendar_url(url: str) -> str | None:
+    """Check that the url points to a TISS calendar, return an error if not."""
+
+    if url == "":
+        return "Empty links don't work *surprised picatchu meme*"
 
     # A better error message if the submitted url is not of the icalendar but
     # of the html page itself.
     if url.startswith("https://tiss.tuwien.ac.at/events/personSchedule.xhtml"):
-        return "Almost, the url we need is at the bottom of the page you submitted", 400
+        return "Almost, the url we need is at the bottom of the page you submitted"
 
     # Inspecting the url
     scheme, loc, path, _, query, _ = urlparse(url)
@@ -91,15 +209,31 @@ def verify():
         and loc == "tiss.tuwien.ac.at"
         and path == "/events/rest/calendar/personal"
     ):
-        return "The url must point to the TISS calendar", 400
+        return "The url must point to the TISS calendar"
     if "token=" not in query:
-        return "The complete calendar url must be submitted, including the token.", 400
+        return "The complete calendar url must be submitted, including the token."
+
+    return None
+
+
+def calendar_url(token: str, locale: str) -> str:
+    return f"{app.config['TISS_CALENDAR_URL']}?token={token}&locale={locale}"
+
+
+@app.route("/verify")
+def verify():
+    url = request.args.get("url", "").strip()
+    if (error := validate_calendar_url(url)) is not None:
+        return error, 400
 
     try:
-        tiss.get_calendar(url)
+        # Parsing it checks that it is a calendar, the cached tree needs no copy
+        _ = tiss.fetch_calendar(url).calendar
     except requests.HTTPError:
         return "TISS rejected this url. Maybe the token is invalid?", 400
-    except ConnectionError:
+    except requests.Timeout:
+        return "TISS took too long to answer, please try again later.", 400
+    except requests.ConnectionError, ConnectionError:
         return "Could not contact TISS. Maybe TISS is down?", 400
     except ValueError:
         return "TISS didn't return an ical file, did you paste the correct url?", 400
@@ -109,7 +243,57 @@ def verify():
     return "Ok"
 
 
+def log_slow_request(status: int, error: str | None, elapsed: float, trace: Trace):
+    token = request.args.get("token")
+    record = {
+        "request_id": request.headers.get("X-Request-ID", uuid.uuid4().hex),
+        "token_hash": hash_token(token) if token is not None else None,
+        "locale": request.args.get("locale"),
+        "google": "google" in request.args,
+        "shorthand": "noshorthand" not in request.args,
+        "status": status,
+        "error": error,
+        "seconds": round(elapsed, 4),
+        "stages": {name: round(t, 4) for name, t in trace.stages.items()},
+        **trace.details,
+    }
+    app.logger.warning("slow request %s", json.dumps(record))
+
+
+def log_slow_requests(view):
+    """Log requests slower than SLOW_REQUEST_THRESHOLD as a line of JSON.
+
+    The token is only logged hashed, like in the statistics.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        threshold = app.config["SLOW_REQUEST_THRESHOLD"]
+        if threshold is None:
+            return view(*args, **kwargs)
+
+        start = time.perf_counter()
+        status = 500
+        error = None
+        with traced() as trace:
+            try:
+                response = app.make_response(view(*args, **kwargs))
+                status = response.status_code
+                return response
+            except Exception as e:
+                # The slowest calendars are often the ones that fail in the end
+                error = type(e).__name__
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                if elapsed >= threshold:
+                    log_slow_request(status, error, elapsed, trace)
+
+    return wrapper
+
+
 @app.route("/personal.ics")
+@log_slow_requests
 def icalendar():
     # If accessed from a browser render fallback
     if "text/html" in request.headers.get("Accept", ""):
@@ -129,22 +313,34 @@ def icalendar():
     is_google = "google" in request.args
     use_shorthand = "noshorthand" not in request.args
 
-    url = f"https://tiss.tuwien.ac.at/events/rest/calendar/personal?token={token}&locale={locale}"
-    cal = tiss.get_calendar(url)
-    try:
-        cal = improve_calendar(
-            cal,
-            google_cal=is_google,
-            use_shorthand=use_shorthand,
-            locale=locale,
+    url = calendar_url(token, locale)
+    options = CalendarOptions(
+        locale=locale, google_cal=is_google, use_shorthand=use_shorthand
+    )
+    with metrics.timed("calendar"):
+        rendered = get_rendered_calendar(
+            url,
+            options,
+            max_staleness=app.config["CALENDAR_MAX_STALENESS"],
+            coalesce_dir=app.config["CALENDAR_COALESCE_DIR"],
         )
-    except Exception as e:
-        # A error occured during reformatting, print a traceback for loggs but
-        # continue with returning the original calendar.
-        traceback.print_exception(e)
 
-    body = cal.to_ical()
-
-    add_usage(get_db(), token)
-
-    return body, 200, {"Content-Type": "text/calendar; charset=utf-8"}
+    with metrics.timed("record_usage"):
+        usage_recorder.record(token)
+
+    # Send the calendar component by component instead of joining it first.
+    response = Response(
+        iter(rendered.chunks),
+        200,
+        {
+            "Content-Type": "text/calendar; charset=utf-8",
+            "Content-Length": str(rendered.size),
+        },
+    )
+    # Most clients poll the same calendar over and over again, if it didn't
+    # change they don't need to download it again.
+    response.set_etag(rendered.etag)
+    response = response.make_conditional(request)
+    if response.status_code == 200:
+        metrics.observe("bettercal_response_bytes", rendered.size, buckets=SIZE_BUCKETS)
+    return response
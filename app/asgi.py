@@ -0,0 +1,197 @@
+"""Serve the app with asyncio, so that waiting for TISS doesn't pin a worker.
+
+The calendar and the verify endpoints are handled here with an async client to
+TISS, everything else is passed on to the flask app. Run it with:
+
+    uv run --extra async -- uvicorn --port 5003 app.asgi:app
+"""
+
+import asyncio
+from urllib.parse import parse_qs
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_etags
+
+import app.tiss as tiss
+from app import app as flask_app
+from app import calendar_url, usage_recorder, validate_calendar_url
+from app.metrics import SIZE_BUCKETS, metrics
+from app.pipeline import (
+    CalendarKey,
+    CalendarOptions,
+    RenderedCalendar,
+    render_calendar,
+    warm_up,
+)
+
+# Unlike the sync workers, a single process waits for many calendars at once.
+MAX_CONNECTIONS = 256
+
+
+class AsyncApp:
+    def __init__(self, wsgi_app) -> None:
+        self.fallback = WsgiToAsgi(wsgi_app)
+        self.client: httpx.AsyncClient | None = None
+        self.inflight: dict[CalendarKey, asyncio.Future[RenderedCalendar]] = {}
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(tiss.READ_TIMEOUT, connect=tiss.CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS),
+            )
+        return self.client
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+
+        headers = dict(scope.get("headers", []))
+        if scope["type"] == "http" and scope["path"] == "/verify":
+            await self.verify(scope, send)
+        elif (
+            scope["type"] == "http"
+            and scope["path"] == "/personal.ics"
+            # The browser fallback page is rendered by flask
+            and b"text/html" not in headers.get(b"accept", b"")
+        ):
+            await self.icalendar(scope, headers, send)
+        else:
+            await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.get_client()
+                # Don't let the first subscriber wait for the resources
+                await asyncio.get_running_loop().run_in_executor(None, warm_up)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.client is not None:
+                    await self.client.aclose()
+                await asyncio.get_running_loop().run_in_executor(
+                    None, usage_recorder.flush
+                )
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def respond(
+        self, send, status: int, body: bytes | tuple[bytes, ...], headers=None
+    ):
+        chunks = (body,) if isinstance(body, bytes) else body
+        headers = headers or {"Content-Type": "text/html; charset=utf-8"}
+        headers["Content-Length"] = str(sum(len(chunk) for chunk in chunks))
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(k.encode(), v.encode()) for k, v in headers.items()],
+            }
+        )
+        for chunk in chunks:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def verify(self, scope, send):
+        args = parse_qs(scope["query_string"].decode(), keep_blank_values=True)
+        url = args.get("url", [""])[0].strip()
+        if (error := validate_calendar_url(url)) is not None:
+            await self.respond(send, 400, error.encode())
+            return
+
+        try:
+            upstream = await tiss.fetch_calendar_async(url, self.get_client())
+            # Parsing is CPU bound and must not block the event loop.
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: upstream.calendar
+            )
+        except httpx.HTTPStatusError:
+            error = "TISS rejected this url. Maybe the token is invalid?"
+        except httpx.TimeoutException:
+            error = "TISS took too long to answer, please try again later."
+        except httpx.TransportError:
+            error = "Could not contact TISS. Maybe TISS is down?"
+        except ValueError:
+            error = "TISS didn't return an ical file, did you paste the correct url?"
+        except Exception:
+            await self.respond(
+                send,
+                500,
+                b"Something unexpected went wrong, maybe create an GitHub issue?",
+            )
+            return
+
+        if error is not None:
+            await self.respond(send, 400, error.encode())
+            return
+        await self.respond(send, 200, b"Ok")
+
+    async def fetch_and_render(
+        self, url: str, options: CalendarOptions
+    ) -> RenderedCalendar:
+        upstream = await tiss.fetch_calendar_async(url, self.get_client())
+        # Enriching is CPU bound and must not block the event loop.
+        return await asyncio.get_running_loop().run_in_executor(
+            None, render_calendar, upstream, options
+        )
+
+    async def get_rendered_calendar(
+        self, url: str, options: CalendarOptions
+    ) -> RenderedCalendar:
+        # Concurrent requests for the same calendar share a single fetch.
+        key = (url, options)
+        if (future := self.inflight.get(key)) is None:
+            future = asyncio.ensure_future(self.fetch_and_render(url, options))
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+
+        # If one of the clients disconnects, the others still need the result.
+        return await asyncio.shield(future)
+
+    async def icalendar(self, scope, headers, send):
+        args = parse_qs(scope["query_string"].decode(), keep_blank_values=True)
+
+        token = args.get("token", [None])[0]
+        if token is None:
+            await self.respond(send, 400, b"No token provided")
+            return
+
+        locale = args.get("locale", [None])[0]
+        if locale is None:
+            await self.respond(send, 400, b"No locale provided")
+            return
+
+        options = CalendarOptions(
+            locale=locale,
+            google_cal="google" in args,
+            use_shorthand="noshorthand" not in args,
+        )
+        with metrics.timed("calendar"):
+            rendered = await self.get_rendered_calendar(
+                calendar_url(token, locale), options
+            )
+
+        with metrics.timed("record_usage"):
+            usage_recorder.record(token)
+
+        etags = parse_etags(headers.get(b"if-none-match", b"").decode())
+        if etags.contains(rendered.etag):
+            await self.respond(send, 304, b"", {"ETag": f'"{rendered.etag}"'})
+            return
+
+        metrics.observe("bettercal_response_bytes", rendered.size, buckets=SIZE_BUCKETS)
+        await self.respond(
+            send,
+            200,
+            rendered.chunks,
+            {
+                "Content-Type": "text/calendar; charset=utf-8",
+                "ETag": f'"{rendered.etag}"',
+            },
+        )
+
+
+app = AsyncApp(flask_app)
@@ -0,0 +1,211 @@
+import hashlib
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class CacheStatistics:
+    size: int
+    maxsize: int
+    hits: int
+    misses: int
+
+
+class LRUCache[K: Hashable, V]:
+    """A thread-safe, size-bounded LRU cache with an optional time to live.
+
+    Entries that are older than the ttl are not returned by `get` but are kept
+    until evicted, so that callers can still revalidate them with `get_stale`.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Workers keep the entries loaded before the fork, but count their own
+        # hits and misses, otherwise the sum of all of them counts the ones of
+        # the master once per worker.
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, stored_at: float) -> bool:
+        return self.ttl is None or time.monotonic() - stored_at < self.ttl
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or not self._is_fresh(entry[0]):
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_stale(self, key: K) -> V | None:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry[1] if entry is not None else None
+
+    def set(self, key: K, value: V) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def statistics(self) -> CacheStatistics:
+        return CacheStatistics(len(self._data), self.maxsize, self.hits, self.misses)
+
+
+class _Call[V]:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: V | None = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight[K: Hashable, V]:
+    """Coalesces concurrent calls with the same key into a single one.
+
+    The first caller for a key does the work, everybody arriving while it is
+    still running waits for it and gets the same result (or exception).
+    """
+
+    def __init__(self) -> None:
+        self.shared = 0
+        self._calls: dict[K, _Call[V]] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: K, fn: Callable[[], V]) -> V:
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result  # type: ignore
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class FileSingleFlight:
+    """Coalesces calls with the same key across processes.
+
+    The work is done while holding a lock file. Whoever finds the lock taken
+    leaves a mark and waits for it, and only then is the result written next
+    to the lock, to be read instead of doing the work again. The directory
+    must only be accessible by us, as the results are the calendars of users.
+    """
+
+    # Results are only needed for the waiting processes, so they can be
+    # removed soon after.
+    MAX_AGE = 60
+
+    _last_sweep = 0.0
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def _check_directory(self):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        # Somebody else might have created it before us, e.g. in /tmp
+        info = os.lstat(self.directory)
+        if (
+            not stat.S_ISDIR(info.st_mode)
+            or info.st_uid != os.getuid()
+            or info.st_mode & 0o077
+        ):
+            raise PermissionError(
+                f"{self.directory} must be a directory only we can access"
+            )
+
+    def do(self, key: str, fn: Callable[[], bytes]) -> bytes:
+        # Only available on unix, which is where we deploy.
+        import fcntl
+
+        self._check_directory()
+        name = hashlib.sha256(key.encode()).hexdigest()
+        lock_path = os.path.join(self.directory, f"{name}.lock")
+        waiting_path = os.path.join(self.directory, f"{name}.waiting")
+        result_path = os.path.join(self.directory, f"{name}.result")
+
+        started = time.time()
+        with open(lock_path, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Ask whoever does the work to leave the result for us.
+                open(waiting_path, "a").close()
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # Keep the lock from being swept while it is in use.
+            os.utime(lock_path)
+            try:
+                # Somebody else finished the work while we were waiting.
+                if os.path.getmtime(result_path) >= started:
+                    with open(result_path, "rb") as f:
+                        return f.read()
+            except FileNotFoundError:
+                pass
+
+            result = fn()
+            try:
+                os.remove(waiting_path)
+            except FileNotFoundError:
+                # Nobody is waiting, so the calendar isn't stored at all.
+                pass
+            else:
+                tmp_path = f"{result_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(result)
+                os.replace(tmp_path, result_path)
+
+        self._sweep()
+        return result
+
+    def _sweep(self):
+        now = time.time()
+        if now - FileSingleFlight._last_sweep < self.MAX_AGE:
+            return
+        FileSingleFlight._last_sweep = now
+
+        for entry in os.scandir(self.directory):
+            try:
+                if now - entry.stat().st_mtime > self.MAX_AGE:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import threading
+from collections.abc import Callable
+
+from app.monitoring import SCHEMA, SCHEMA_VERSION
+
+# How long to wait for another worker that is writing, in milliseconds
+BUSY_TIMEOUT = 5000
+# Moves the usage from the old statistics table into statistics_daily
+MIGRATE_FILE = "app/resources/migrate.sql"
+
+
+def statements(script: str) -> list[str]:
+    # executescript would commit the transaction the migration runs in
+    return [statement for statement in script.split(";") if statement.strip()]
+
+
+def migrate(db: sqlite3.Connection):
+    """Create the tables or update them to the current schema, once per file."""
+
+    if db.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    # WAL is remembered by the file, so it only needs to be set once
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        # Another worker might have been faster
+        if db.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            db.rollback()
+            return
+
+        tables = {
+            name
+            for (name,) in db.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'"
+            )
+        }
+        if "statistics" in tables and "statistics_daily" not in tables:
+            with open(MIGRATE_FILE) as f:
+                for statement in statements(f.read()):
+                    db.execute(statement)
+
+        for statement in statements(SCHEMA):
+            db.execute(statement)
+        db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def open_database(path: str) -> sqlite3.Connection:
+    # The default statement cache of 128 keeps all of our queries prepared
+    db = sqlite3.connect(path)
+    db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+    # With WAL this only risks losing the last transactions on a power loss,
+    # but never corrupts the database, and saves a sync on every commit.
+    db.execute("PRAGMA synchronous = NORMAL")
+    migrate(db)
+    return db
+
+
+class ConnectionManager:
+    """Keeps one connection per thread for the whole lifetime of a worker.
+
+    Opening a connection and checking the schema happens only once, and the
+    connection keeps its prepared statements between requests.
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection]) -> None:
+        self.connect = connect
+        self.opened = 0
+        self._local = threading.local()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Connections must not be shared with the parent process
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self.connect()
+            self.opened += 1
+        return db
@@ -0,0 +1,251 @@
+"""Rewrite calendars line by line instead of parsing them completely.
+
+Parsing the whole calendar with icalendar, walking it and serializing it again
+is the most expensive part of a request. However, we only change a few
+properties of the events, so this unfolds the lines, rewrites the summary,
+location and description of lectures and passes everything else through as
+is. The enrichment itself is the same as in improve_calendar.
+"""
+
+import re
+
+from icalendar.parser import Contentline
+from icalendar.prop import vText
+
+from app.format import (
+    CALENDAR_NAME,
+    PRODID,
+    enrich_event_cached,
+    prepared_signup_events,
+    summary_regex,
+)
+
+name_regex = re.compile("[^;:]*")
+
+# Properties of the calendar itself that we replace
+REPLACED_HEADER = {"PRODID", "NAME", "X-WR-CALNAME"}
+# Properties of events that we read and replace
+EVENT_PROPERTIES = {"SUMMARY", "LOCATION", "DESCRIPTION"}
+
+
+class LogicalLine:
+    "A content line which might be folded over multiple physical lines"
+
+    __slots__ = ("physical", "name")
+
+    def __init__(self, first: str) -> None:
+        self.physical = [first]
+        self.name = ""
+
+    def unfolded(self) -> str:
+        if len(self.physical) == 1:
+            return self.physical[0]
+        return self.physical[0] + "".join(line[1:] for line in self.physical[1:])
+
+
+def split_lines(body: str) -> list[LogicalLine]:
+    lines: list[LogicalLine] = []
+    for line in body.split("\n"):
+        line = line.removesuffix("\r")
+        if line[:1] in (" ", "\t") and lines:
+            lines[-1].physical.append(line)
+        elif line:
+            lines.append(LogicalLine(line))
+
+    for line in lines:
+        match = name_regex.match(line.unfolded())
+        line.name = match.group(0).upper()  # type: ignore
+    return lines
+
+
+def fold(line: str) -> str:
+    """Fold the line into lines of at most 75 octets.
+
+    icalendar does this character by character, which is slow for our long
+    descriptions.
+    """
+
+    data = line.encode()
+    if len(data) <= 75:
+        return line
+
+    parts = []
+    start = 0
+    limit = 75
+    while len(data) - start > limit:
+        end = start + limit
+        # Never split a multi byte character
+        while data[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(data[start:end])
+        start = end
+        # The following lines start with a space
+        limit = 74
+    parts.append(data[start:])
+    return b"\r\n ".join(parts).decode()
+
+
+def content_line(name: str, value: str) -> str:
+    # Let icalendar escape the value, so that it is the same as with the parser.
+    return fold(f"{name}:{vText(value).to_ical().decode()}")
+
+
+def serialize(lines: list[str]) -> bytes:
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+
+def rewrite_calendar(
+    body: str,
+    use_shorthand: bool = True,
+    google_cal: bool = False,
+    locale: str | None = None,
+) -> list[bytes]:
+    """Rewrite the calendar like improve_calendar, one chunk per component.
+
+    Raises a ValueError if the calendar has an unexpected structure, in which
+    case the caller should fall back to the full parser.
+    """
+
+    if locale is None:
+        locale = "de"
+
+    lines = split_lines(body)
+    if (
+        len(lines) < 2
+        or lines[0].unfolded().upper() != "BEGIN:VCALENDAR"
+        or lines[-1].unfolded().upper() != "END:VCALENDAR"
+    ):
+        raise ValueError("Not a calendar")
+
+    # Split into the properties of the calendar and its components.
+    header: list[LogicalLine] = []
+    components: list[list[LogicalLine]] = []
+    depth = 0
+    for line in lines[1:-1]:
+        if line.name == "BEGIN":
+            if depth == 0:
+                components.append([])
+            depth += 1
+        if depth == 0:
+            header.append(line)
+        else:
+            components[-1].append(line)
+        if line.name == "END":
+            depth -= 1
+            if depth < 0:
+                raise ValueError("Unbalanced END")
+    if depth != 0:
+        raise ValueError("Unbalanced BEGIN")
+
+    header_lines = ["BEGIN:VCALENDAR"]
+    for line in header:
+        if line.name not in REPLACED_HEADER:
+            header_lines.extend(line.physical)
+    header_lines.append(content_line("PRODID", PRODID))
+    header_lines.append(content_line("NAME", CALENDAR_NAME))
+    header_lines.append(content_line("X-WR-CALNAME", CALENDAR_NAME))
+    chunks = [serialize(header_lines)]
+
+    seen_lecture_numbers: set[str] = set()
+    memo: dict[tuple, RewrittenEvent] = {}
+    for component in components:
+        if component[0].unfolded().upper() != "BEGIN:VEVENT":
+            chunks.append(serialize([p for line in component for p in line.physical]))
+            continue
+
+        chunks.append(
+            rewrite_event(
+                component,
+                seen_lecture_numbers,
+                memo,
+                use_shorthand,
+                google_cal,
+                locale,
+            )
+        )
+
+    for signup in prepared_signup_events(seen_lecture_numbers, google_cal, locale):
+        if signup.ical:
+            chunks.append(signup.ical)
+
+    chunks.append(b"END:VCALENDAR\r\n")
+    return chunks
+
+
+# The lecture number, new lines and the properties they replace of an event.
+type RewrittenEvent = tuple[str, list[str], set[str]]
+
+
+def rewrite_event(
+    component: list[LogicalLine],
+    seen_lecture_numbers: set[str],
+    memo: dict[tuple, RewrittenEvent],
+    use_shorthand: bool,
+    google_cal: bool,
+    locale: str,
+) -> bytes:
+    # Only look at the properties of the event itself, not of nested alarms.
+    properties: dict[str, str] = {}
+    depth = 0
+    for line in component:
+        if line.name == "BEGIN":
+            depth += 1
+        elif line.name == "END":
+            depth -= 1
+        elif depth == 1 and line.name in EVENT_PROPERTIES:
+            key = line.name.lower()
+            if key in properties:
+                raise ValueError(f"Duplicate {line.name}")
+            _, _, value = Contentline(line.unfolded()).parts()
+            properties[key] = vText.from_ical(value)
+
+    summary = properties.get("summary")
+    if summary is None or not summary_regex.match(summary):
+        return serialize([p for line in component for p in line.physical])
+    if "description" not in properties:
+        raise ValueError("Event without description")
+
+    # Lectures repeat every week, so only enrich and serialize them once.
+    slot = (summary, properties.get("location"), properties["description"])
+    if (rewritten := memo.get(slot)) is None:
+        rewritten = memo[slot] = enrich_lines(
+            properties, use_shorthand, google_cal, locale
+        )
+    number, new_lines, replaced = rewritten
+    seen_lecture_numbers.add(number)
+
+    output = []
+    depth = 0
+    for line in component:
+        if line.name == "BEGIN":
+            depth += 1
+        elif line.name == "END":
+            depth -= 1
+            if depth == 0:
+                output.extend(new_lines)
+        elif depth == 1 and line.name in replaced:
+            continue
+        output.extend(line.physical)
+
+    return serialize(output)
+
+
+def enrich_lines(
+    properties: dict[str, str], use_shorthand: bool, google_cal: bool, locale: str
+) -> RewrittenEvent:
+    enriched = enrich_event_cached(properties, use_shorthand, google_cal, locale)
+
+    replaced = {"SUMMARY", "DESCRIPTION"}
+    new_lines = [
+        content_line("SUMMARY", enriched.summary),
+        content_line("DESCRIPTION", enriched.description),
+    ]
+    if enriched.location is not None:
+        replaced.add("LOCATION")
+        new_lines.append(content_line("LOCATION", enriched.location))
+    if enriched.html_description is not None:
+        new_lines.append(
+            content_line("X-ALT-DESC;FMTTYPE=TEXT/HTML", enriched.html_description)
+        )
+
+    return enriched.number, new_lines, replaced
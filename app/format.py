@@ -1,13 +1,22 @@
 import csv
+import hashlib
 import html
+import os
+import pickle
 import re
 import string
+import traceback
+from collections.abc import Callable, Iterable, Iterator
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from functools import cache
 
 import icalendar
 from icalendar import Component
+from icalendar.parser import Contentlines
+
+from app.cache import CacheStatistics, LRUCache
+from app.metrics import metrics
+from app.registry import ResourceRegistry
 
 summary_regex = re.compile("([0-9A-Z]{3}\\.[0-9A-Z]{3}) ([A-Z]{2}) (.*)")
 word_split_regex = re.compile(
@@ -22,6 +31,9 @@ class MultiLangString:
         self.de = de
         self.en = en if en is not None else de
 
+    def get(self, lang: str) -> str:
+        return self.en if lang == "en" else self.de
+
 
 @dataclass(kw_only=True, slots=True)
 class Event:
@@ -40,6 +52,8 @@ class Event:
     room_url: str | None = None
     map_url: str | None = None
     lecturetube_url: str | None = None
+    # Set if the room is known, with everything about it already rendered
+    room_record: "Room | None" = None  # noqa: UP037
 
     def plain_description(self, lang: str) -> str:
         text = ""
@@ -47,15 +61,10 @@ class Event:
             text += f"{self.name} {self.lecture_type}\n"
         text += f"{self.description}\n\n"
 
-        if self.room:
-            text += "Room:\n" if lang == "en" else "Raum:\n"
-            text += self.room
-            if self.floor is not None:
-                text += f", {self.floor.en if lang == 'en' else self.floor.de}"
-            text += "\n"
-            if self.map_url is not None:
-                text += f"{self.map_url}\n"
-            text += "\n"
+        if self.room_record is not None:
+            text += self.room_record.plain.get(lang)
+        elif self.room:
+            text += plain_room(self.room, self.floor, self.map_url, lang)
 
         details = [
             (self.tiss_url, "TISS"),
@@ -78,20 +87,10 @@ class Event:
             )
         text += f"{html.escape(self.description)}<br><br>"
 
-        if self.room:
-            text += "Room:<br>" if lang == "en" else "Raum:<br>"
-
-            if self.map_url:
-                text += f'<a href="{self.map_url}">{html.escape(self.room)}</a>'
-            else:
-                text += html.escape(self.room)
-
-            if self.floor is not None:
-                text += (
-                    f", {html.escape(self.floor.en if lang == 'en' else self.floor.de)}"
-                )
-
-            text += "<br><br>"
+        if self.room_record is not None:
+            text += self.room_record.html.get(lang)
+        elif self.room:
+            text += html_room(self.room, self.floor, self.map_url, lang)
 
         details = [
             (self.tiss_url, "TISS"),
@@ -110,6 +109,113 @@ class Event:
         return text
 
 
+def plain_room(
+    room: str, floor: MultiLangString | None, map_url: str | None, lang: str
+) -> str:
+    text = "Room:\n" if lang == "en" else "Raum:\n"
+    text += room
+    if floor is not None:
+        text += f", {floor.get(lang)}"
+    text += "\n"
+    if map_url is not None:
+        text += f"{map_url}\n"
+    return text + "\n"
+
+
+def html_room(
+    room: str, floor: MultiLangString | None, map_url: str | None, lang: str
+) -> str:
+    text = "Room:<br>" if lang == "en" else "Raum:<br>"
+
+    if map_url:
+        text += f'<a href="{map_url}">{html.escape(room)}</a>'
+    else:
+        text += html.escape(room)
+
+    if floor is not None:
+        text += f", {html.escape(floor.get(lang))}"
+
+    return text + "<br><br>"
+
+
+@dataclass(frozen=True, slots=True)
+class Room:
+    "Everything we add to events in a room, prepared ahead of time"
+
+    name: str
+    address: str
+    floor: MultiLangString | None
+    code: str
+    room_url: str
+    map_url: str
+    lecturetube_url: str | None
+    # The room section of the descriptions
+    plain: MultiLangString
+    html: MultiLangString
+
+
+def normalize_room_name(name: str) -> str:
+    # TISS isn't always consistent with whitespace and case
+    return " ".join(name.split()).casefold()
+
+
+def build_room_records(
+    rooms: dict[str, tuple[str, MultiLangString, str, str]],
+    lecturetube_available_rooms: set[str],
+) -> dict[str, Room]:
+    """All rooms by their name and their normalized name."""
+
+    records = {}
+    for name, (address, floor, code, url) in rooms.items():
+        # FIXME: the floor information in the dataset is all over the place.
+        # We should create a better more universal dataset
+        floor = floor if floor is not None else create_floor_fallback(code)
+        map_url = f"https://maps.tuwien.ac.at/?q={code}#map"
+        lecturetube_url = None
+        if code in lecturetube_available_rooms:
+            lecturetube_url = f"https://live.video.tuwien.ac.at/room/{code}/player.html"
+
+        records[name] = Room(
+            name,
+            address,
+            floor,
+            code,
+            url,
+            map_url,
+            lecturetube_url,
+            MultiLangString(
+                plain_room(name, floor, map_url, "de"),
+                plain_room(name, floor, map_url, "en"),
+            ),
+            MultiLangString(
+                html_room(name, floor, map_url, "de"),
+                html_room(name, floor, map_url, "en"),
+            ),
+        )
+
+    # Exact names take precedence over normalized ones
+    index = {normalize_room_name(name): record for name, record in records.items()}
+    index.update(records)
+    return index
+
+
+PRODID = "-//flofriday//Better TISS CAL//EN"
+CALENDAR_NAME = "Better TISS"
+
+
+@dataclass(frozen=True, slots=True)
+class EnrichedEvent:
+    "The new properties of an event after enriching it"
+
+    number: str
+    summary: str
+    # None if the original location should be kept
+    location: str | None
+    description: str
+    # None if there should be no alternative html description
+    html_description: str | None
+
+
 def improve_calendar(
     cal: Component,
     use_shorthand: bool = True,
@@ -120,6 +226,7 @@ def improve_calendar(
         locale = "de"
 
     seen_lecture_numbers: set[str] = set()
+    memo: EnrichmentMemo = {}
 
     for component in cal.walk():
         if component.name != "VEVENT" or not summary_regex.match(
@@ -127,49 +234,201 @@ def improve_calendar(
         ):
             continue
 
-        # Parse the event and enrich it
-        event = event_from_ical(component)
-        seen_lecture_numbers.add(event.number)
-        if use_shorthand:
-            event.shorthand = create_shorthand(event.name)
-        event = add_location(event)
-
-        # Serialize the summary
-        summary = event.shorthand if event.shorthand is not None else event.name
-        summary += f" {event.lecture_type}"
-        if event.additional is not None:
-            summary += " - " + event.additional
+        enriched = enrich_event_memoized(
+            memo, component, use_shorthand, google_cal, locale
+        )
+        seen_lecture_numbers.add(enriched.number)
+
         component.pop("summary")
-        component.add("summary", summary)
+        component.add("summary", enriched.summary)
 
-        # Add tuwel
-        if course := read_courses().get(event.number, None):
-            event.tuwel_url = course.tuwel_url
-        # Serialize the address
-        if event.address is not None:
+        if enriched.location is not None:
             component.pop("location")
-            component.add("location", event.address)
-
-        # Serialize the description
-        plain_description = event.plain_description(locale)
-        html_description = event.html_description(locale)
+            component.add("location", enriched.location)
 
         component.pop("description")
-        if google_cal:
-            # So google calendar ignored the standard that says that the
-            # description should only contain plain text. Then when some clients
-            # (rightfully so) didn't support html in the description where the
-            # standard says that there should be no html, they blamed it on the
-            # clients and gaslight them.
-            # Normally, I would congratulate such a bold and wrongfully confident
-            # move but now I need to adapt to it in my code and I am pissed.
-            component.add("description", html_description)
-        else:
-            component.add("description", plain_description)
-            component.add("x-alt-desc;fmttype=text/html", html_description)
+        component.add("description", enriched.description)
+        if enriched.html_description is not None:
+            component.add("x-alt-desc;fmttype=text/html", enriched.html_description)
 
     # Insert signup dates
-    for lecture in sorted(seen_lecture_numbers):
+    for signup in prepared_signup_events(seen_lecture_numbers, google_cal, locale):
+        for event in signup.events:
+            cal.add_component(event)
+
+    # Set some metadata
+    cal.pop("prodid")
+    cal.add("prodid", PRODID)
+    cal.add("name", CALENDAR_NAME)
+    cal.add("x-wr-calname", CALENDAR_NAME)
+
+    return cal
+
+
+def enrich_event(
+    component, use_shorthand: bool, google_cal: bool, locale: str
+) -> EnrichedEvent:
+    """Enrich a single lecture.
+
+    The component only needs to provide the summary, location and description
+    with `get`, so this works for parsed components and plain dicts alike.
+    """
+
+    # Parse the event and enrich it
+    event = event_from_ical(component)
+    if use_shorthand:
+        event.shorthand = create_shorthand(event.name)
+    event = add_location(event)
+
+    # Serialize the summary
+    summary = event.shorthand if event.shorthand is not None else event.name
+    summary += f" {event.lecture_type}"
+    if event.additional is not None:
+        summary += " - " + event.additional
+
+    # Add tuwel
+    if course := read_courses().get(event.number, None):
+        event.tuwel_url = course.tuwel_url
+
+    # Serialize the description
+    plain_description = event.plain_description(locale)
+    html_description = event.html_description(locale)
+
+    if google_cal:
+        # So google calendar ignored the standard that says that the
+        # description should only contain plain text. Then when some clients
+        # (rightfully so) didn't support html in the description where the
+        # standard says that there should be no html, they blamed it on the
+        # clients and gaslight them.
+        # Normally, I would congratulate such a bold and wrongfully confident
+        # move but now I need to adapt to it in my code and I am pissed.
+        return EnrichedEvent(
+            event.number, summary, event.address, html_description, None
+        )
+
+    return EnrichedEvent(
+        event.number, summary, event.address, plain_description, html_description
+    )
+
+
+# The enriched events of a single calendar by summary, location and description
+type EnrichmentMemo = dict[tuple[str, str | None, str | None], EnrichedEvent]
+
+
+def enrich_event_memoized(
+    memo: EnrichmentMemo, component, use_shorthand: bool, google_cal: bool, locale: str
+) -> EnrichedEvent:
+    """Enrich a lecture, but only once for every time it repeats.
+
+    Most lectures happen every week in the same room with the same description,
+    so there are only a few distinct ones per calendar. The memo must only be
+    used with the same options.
+    """
+
+    key = (
+        component.get("summary"),
+        component.get("location"),
+        component.get("description"),
+    )
+    if (enriched := memo.get(key)) is None:
+        enriched = memo[key] = enrich_event_cached(
+            component, use_shorthand, google_cal, locale
+        )
+    return enriched
+
+
+FRAGMENT_CACHE_MAXSIZE = 8192
+SIGNUP_CACHE_MAXSIZE = 8192
+
+# Enriched events across all calendars, as many students share the same lectures.
+_fragment_cache: LRUCache[tuple, EnrichedEvent] = LRUCache(FRAGMENT_CACHE_MAXSIZE)
+# Signup events for a course, also shared between calendars.
+_signup_cache: LRUCache[tuple, "PreparedSignup"] = LRUCache(SIGNUP_CACHE_MAXSIZE)  # noqa: UP037
+# The resource version the caches were filled with
+_cache_version: str | None = None
+
+
+def cache_version() -> str:
+    """The current resource version, after clearing caches of older ones."""
+
+    global _cache_version
+    version = resource_version()
+    if version != _cache_version:
+        _fragment_cache.clear()
+        _signup_cache.clear()
+        _cache_version = version
+    return version
+
+
+def enrich_event_cached(
+    component, use_shorthand: bool, google_cal: bool, locale: str
+) -> EnrichedEvent:
+    """Like enrich_event, but shared between calendars.
+
+    The summary contains the course number, the lecture type and additional
+    text, the location is the room. Everything else we add comes from the
+    resources, so the cache is cleared when they change.
+    """
+
+    version = cache_version()
+    key = (
+        component.get("summary"),
+        component.get("location"),
+        component.get("description"),
+        use_shorthand,
+        google_cal,
+        locale,
+        # Results computed with the old resources might still come in
+        version,
+    )
+    if (enriched := _fragment_cache.get(key)) is None:
+        enriched = enrich_event(component, use_shorthand, google_cal, locale)
+        _fragment_cache.set(key, enriched)
+    return enriched
+
+
+def get_fragment_statistics() -> CacheStatistics:
+    return _fragment_cache.statistics()
+
+
+def get_signup_statistics() -> CacheStatistics:
+    return _signup_cache.statistics()
+
+
+@dataclass(frozen=True)
+class PreparedSignup:
+    "The signup events of a course, as components and serialized"
+
+    events: tuple[icalendar.Event, ...]
+    ical: bytes
+
+
+def prepared_signup_events(
+    lecture_numbers: Iterable[str], google_cal: bool, locale: str
+) -> list[PreparedSignup]:
+    """Like create_signup_events, but every course is only built once.
+
+    The events must not be modified, as they are shared between calendars.
+    """
+
+    version = cache_version()
+    prepared = []
+    with metrics.timed("signups"):
+        for lecture in sorted(lecture_numbers):
+            key = (lecture, google_cal, locale, version)
+            if (signup := _signup_cache.get(key)) is None:
+                events = tuple(create_signup_events([lecture], google_cal, locale))
+                signup = PreparedSignup(events, b"".join(e.to_ical() for e in events))
+                _signup_cache.set(key, signup)
+            prepared.append(signup)
+    return prepared
+
+
+def create_signup_events(
+    lecture_numbers: Iterable[str], google_cal: bool, locale: str
+) -> list[icalendar.Event]:
+    signups = []
+    for lecture in sorted(lecture_numbers):
         course = read_courses().get(lecture, None)
         if course is None:
             continue
@@ -215,15 +474,35 @@ def improve_calendar(
                     f'<a href="{course.tiss_url}">Register on Tiss</a>',
                 )
 
-            cal.add_component(signup)
+            signups.append(signup)
 
-    # Set some metadata
-    cal.pop("prodid")
-    cal.add("prodid", "-//flofriday//Better TISS CAL//EN")
-    cal.add("name", "Better TISS")
-    cal.add("x-wr-calname", "Better TISS")
+    return signups
 
-    return cal
+
+def iter_ical(
+    cal: Component, serialized_timezone: Callable[[str], bytes | None] | None = None
+) -> Iterator[bytes]:
+    """Serialize the calendar one component at a time.
+
+    The result is the same as cal.to_ical(), but we never need to hold the
+    content lines of all events at once and can start sending right away.
+    Timezones for which serialized_timezone has the bytes aren't serialized
+    again.
+    """
+
+    # Everything but the END of the calendar itself
+    header = cal.property_items(recursive=False)[:-1]
+    yield Contentlines(
+        cal.content_line(name, value) for name, value in header
+    ).to_ical()
+
+    for component in cal.subcomponents:
+        block = None
+        if serialized_timezone is not None and component.name == "VTIMEZONE":
+            block = serialized_timezone(str(component["TZID"]))
+        yield block if block is not None else component.to_ical()
+
+    yield f"END:{cal.name}\r\n".encode()
 
 
 def event_from_ical(component) -> Event:
@@ -257,7 +536,14 @@ def event_from_ical(component) -> Event:
 
 
 def create_shorthand(name: str) -> str:
-    shorthands = read_shorthands()
+    # Almost all lectures are in courses.csv
+    if (shorthand := read_shorthand_index().get(name)) is not None:
+        return shorthand
+
+    return lookup_shorthand(name, read_shorthands())
+
+
+def lookup_shorthand(name: str, shorthands: dict[str, str]) -> str:
     if name.lower() in shorthands:
         return shorthands[name.lower()].upper()
 
@@ -302,23 +588,22 @@ def is_valid_shorthand(shorthand: str) -> bool:
 
 
 def add_location(event: Event) -> Event:
-    rooms = read_rooms()
-    if event.room not in rooms:
+    if event.room is None:
         return event
 
-    (address, floor, code, url) = rooms[event.room]
-    event.address = address
-
-    # FIXME: the floor information in the dataset is all over the place.
-    # We should create a better more universal dataset
-    event.floor = floor if floor is not None else create_floor_fallback(code)
-    event.room_code = code
-    event.room_url = url
-    event.map_url = f"https://maps.tuwien.ac.at/?q={code}#map"
-    if code in read_lecturetube_available_rooms():
-        event.lecturetube_url = (
-            f"https://live.video.tuwien.ac.at/room/{code}/player.html"
-        )
+    records = read_room_records()
+    record = records.get(event.room) or records.get(normalize_room_name(event.room))
+    if record is None:
+        return event
+
+    event.room = record.name
+    event.room_record = record
+    event.address = record.address
+    event.floor = record.floor
+    event.room_code = record.code
+    event.room_url = record.room_url
+    event.map_url = record.map_url
+    event.lecturetube_url = record.lecturetube_url
     return event
 
 
@@ -349,6 +634,35 @@ def create_floor_fallback(room_code: str) -> MultiLangString | None:
         return MultiLangString(floor_code)
 
 
+RESOURCE_FILES = [
+    "app/resources/courses.csv",
+    "app/resources/rooms.csv",
+    "app/resources/shorthands.csv",
+    "app/resources/lecturetube_availability.csv",
+    "app/resources/timezones.ics",
+]
+
+
+def compute_resource_version() -> str:
+    """A fingerprint of all data files used to enrich the calendar."""
+
+    digest = hashlib.sha256()
+    for path in RESOURCE_FILES:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def resource_version() -> str:
+    """The version of the resources currently used.
+
+    Caches of anything derived from the resources should include it in their
+    keys.
+    """
+
+    return resources.get().version
+
+
 @dataclass(frozen=True)
 class Course:
     id: str | None
@@ -360,8 +674,7 @@ class Course:
     deregistration_end: datetime | None
 
 
-@cache
-def read_courses() -> dict[str, Course]:
+def parse_courses() -> dict[str, Course]:
     id_to_course: dict[str, Course] = {}
 
     # FIXME: Probably refactor into something that can be reused to also process
@@ -416,8 +729,7 @@ def read_courses() -> dict[str, Course]:
     return id_to_course
 
 
-@cache
-def read_shorthands() -> dict[str, str]:
+def parse_shorthands() -> dict[str, str]:
     with open("app/resources/shorthands.csv") as f:
         # The first line is a header
         lines = f.readlines()[1:]
@@ -436,8 +748,7 @@ def read_shorthands() -> dict[str, str]:
     return shorthands
 
 
-@cache
-def read_rooms() -> dict[str, tuple[str, MultiLangString, str, str]]:
+def parse_rooms() -> dict[str, tuple[str, MultiLangString, str, str]]:
     upper_floor_patttern = re.compile(r"(\d). ?(Stock|Obergescho(ss|ß)|OG)")
     ground_floor_patttern = re.compile(r"(EG|Erdgescho(ss|ß))")
     roof_floor_patttern = re.compile(r"(DG|Erdgescho(ss|ß))")
@@ -481,8 +792,7 @@ def read_rooms() -> dict[str, tuple[str, MultiLangString, str, str]]:
     return rooms
 
 
-@cache
-def read_lecturetube_available_rooms() -> set[str]:
+def parse_lecturetube_available_rooms() -> set[str]:
     available_rooms = set()
 
     with open("app/resources/lecturetube_availability.csv") as f:
@@ -491,3 +801,152 @@ def read_lecturetube_available_rooms() -> set[str]:
         for fields in reader:
             available_rooms.add(fields[0])
     return available_rooms
+
+
+def build_shorthand_index(
+    courses: dict[str, Course], shorthands: dict[str, str]
+) -> dict[str, str]:
+    index = {}
+    for course in courses.values():
+        if course.name is not None:
+            index[course.name] = lookup_shorthand(course.name, shorthands)
+    return index
+
+
+@dataclass
+class ShorthandReport:
+    # Shorthands used by more than one lecture
+    collisions: dict[str, set[str]]
+    # Lectures for which no valid shorthand could be generated
+    invalid: set[str]
+
+
+def create_shorthand_report(
+    courses: dict[str, Course], shorthands: dict[str, str]
+) -> ShorthandReport:
+    """Find the lectures which would profit the most from a curated shorthand."""
+
+    report = ShorthandReport({}, set())
+    lectures: dict[str, set[str]] = {}
+    for course in courses.values():
+        if course.name is None:
+            continue
+
+        shorthand = lookup_shorthand(course.name, shorthands)
+        if shorthand == course.name:
+            report.invalid.add(course.name)
+        else:
+            lectures.setdefault(shorthand, set()).add(course.name)
+
+    report.collisions = {
+        shorthand: names for shorthand, names in lectures.items() if len(names) > 1
+    }
+    return report
+
+
+BUNDLE_FILE = "app/resources/bundle.pickle"
+# Increment whenever the fields of the bundle change, so that old files aren't
+# used anymore.
+BUNDLE_LAYOUT = 3
+
+
+@dataclass(frozen=True)
+class ResourceBundle:
+    "All resources parsed ahead of time, so that workers only need to unpickle them"
+
+    layout: int
+    version: str
+    courses: dict[str, Course]
+    shorthands: dict[str, str]
+    # The shorthand of every course name in courses.csv
+    shorthand_index: dict[str, str]
+    rooms: dict[str, tuple[str, MultiLangString, str, str]]
+    lecturetube_available_rooms: set[str]
+    # The rooms by their name and normalized name
+    room_records: dict[str, Room]
+
+
+def build_resources(version: str) -> ResourceBundle:
+    courses = parse_courses()
+    shorthands = parse_shorthands()
+    rooms = parse_rooms()
+    lecturetube_available_rooms = parse_lecturetube_available_rooms()
+    return ResourceBundle(
+        BUNDLE_LAYOUT,
+        version,
+        courses,
+        shorthands,
+        build_shorthand_index(courses, shorthands),
+        rooms,
+        lecturetube_available_rooms,
+        build_room_records(rooms, lecturetube_available_rooms),
+    )
+
+
+def compile_resources(path: str = BUNDLE_FILE):
+    bundle = build_resources(compute_resource_version())
+    # Workers that start while we write must never see half a file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_bundle(version: str) -> ResourceBundle | None:
+    """The compiled resources, None if they are missing or of another version."""
+
+    try:
+        with open(BUNDLE_FILE, "rb") as f:
+            bundle = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # Probably compiled by another version of this file
+        traceback.print_exception(e)
+        return None
+
+    if (
+        not isinstance(bundle, ResourceBundle)
+        or getattr(bundle, "layout", None) != BUNDLE_LAYOUT
+        or bundle.version != version
+    ):
+        return None
+    return bundle
+
+
+def load_resources() -> ResourceBundle:
+    version = compute_resource_version()
+    if (bundle := read_bundle(version)) is not None:
+        return bundle
+    return build_resources(version)
+
+
+# How often to check whether the resources changed, in seconds
+RESOURCE_RELOAD_INTERVAL = 30
+
+# The resources are reloaded in the background whenever the files change.
+resources = ResourceRegistry(RESOURCE_FILES, load_resources, RESOURCE_RELOAD_INTERVAL)
+
+
+def read_courses() -> dict[str, Course]:
+    return resources.get().courses
+
+
+def read_shorthands() -> dict[str, str]:
+    return resources.get().shorthands
+
+
+def read_shorthand_index() -> dict[str, str]:
+    return resources.get().shorthand_index
+
+
+def read_rooms() -> dict[str, tuple[str, MultiLangString, str, str]]:
+    return resources.get().rooms
+
+
+def read_lecturetube_available_rooms() -> set[str]:
+    return resources.get().lecturetube_available_rooms
+
+
+def read_room_records() -> dict[str, Room]:
+    return resources.get().room_records
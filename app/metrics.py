@@ -0,0 +1,292 @@
+import atexit
+import glob
+import json
+import os
+import secrets
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+# In seconds, from a cached calendar to TISS taking its time
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    20,
+)
+EVENT_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+SIZE_BUCKETS = (10_000, 25_000, 50_000, 100_000, 250_000, 500_000, 1_000_000)
+
+# How often every worker writes its metrics to the metrics directory, in seconds
+METRICS_WRITE_INTERVAL = 5
+
+# The type and help of every metric we export
+METRICS = {
+    "bettercal_stage_seconds": (
+        "histogram",
+        "Time spent in every stage of serving a calendar.",
+    ),
+    "bettercal_calendar_events": ("histogram", "Events in every rendered calendar."),
+    "bettercal_response_bytes": ("histogram", "Size of the calendars sent."),
+    "bettercal_upstream_errors_total": (
+        "counter",
+        "Failed requests to TISS by the type of error.",
+    ),
+    "bettercal_cache_hits_total": ("counter", "Lookups that were in the cache."),
+    "bettercal_cache_misses_total": ("counter", "Lookups that were not in the cache."),
+}
+
+type Labels = tuple[tuple[str, str], ...]
+type Sample = tuple[str, Labels, float]
+
+
+def histogram_samples(
+    name: str, labels: Labels, buckets: tuple[float, ...], counts: list[float]
+) -> Iterator[Sample]:
+    # counts has the observations of every bucket, then of +Inf, then their sum
+    cumulative = 0
+    for bucket, count in zip((*buckets, "+Inf"), counts[:-1], strict=True):
+        cumulative += count
+        yield (f"{name}_bucket", (*labels, ("le", str(bucket))), cumulative)
+    yield (f"{name}_sum", labels, counts[-1])
+    yield (f"{name}_count", labels, cumulative)
+
+
+@dataclass
+class Trace:
+    """What happened while serving a single request."""
+
+    # The seconds spent in every stage, stages can contain other stages
+    stages: dict[str, float] = field(default_factory=dict)
+    details: dict[str, object] = field(default_factory=dict)
+
+
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+
+
+@contextmanager
+def traced() -> Iterator[Trace]:
+    """Collect the stages timed in here, in this thread, into a trace."""
+
+    trace = Trace()
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+def note(**details):
+    """Add details to the trace of the current request, if it is traced."""
+
+    if (trace := _trace.get()) is not None:
+        trace.details.update(details)
+
+
+class Metrics:
+    """Counters and histograms of a single process.
+
+    Histograms are exported as the samples of their cumulative buckets, sum and
+    count. All of them only ever grow, so the metrics of all gunicorn workers
+    are the sum of their samples. For that every worker writes
+    its samples to its own file in the directory, see `collect`.
+    """
+
+    def __init__(self, directory: str | None = None) -> None:
+        self.directory = directory
+        # Samples that are read from elsewhere when the metrics are written
+        self.collectors: list[Callable[[], Iterable[Sample]]] = []
+        self._samples: dict[tuple[str, Labels], float] = {}
+        # The buckets and counts of every histogram, see histogram_samples
+        self._histograms: dict[
+            tuple[str, Labels], tuple[tuple[float, ...], list[float]]
+        ] = {}
+        self._lock = threading.Lock()
+        self._writer: threading.Thread | None = None
+        self._name = f"{os.getpid()}-{secrets.token_hex(4)}"
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.write)
+
+    def _reset(self):
+        # Every worker counts for itself, in its own file. Also, threads don't
+        # survive a fork.
+        self._samples = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._writer = None
+        self._name = f"{os.getpid()}-{secrets.token_hex(4)}"
+
+    def _start_writer(self):
+        if self.directory is None or self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_periodically, name="metrics-writer", daemon=True
+                )
+                self._writer.start()
+
+    def _write_periodically(self):
+        while True:
+            time.sleep(METRICS_WRITE_INTERVAL)
+            try:
+                self.write()
+            except Exception as e:
+                traceback.print_exception(e)
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1):
+        key = (name, labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + value
+        self._start_writer()
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        labels: Labels = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        key = (name, labels)
+        with self._lock:
+            if (histogram := self._histograms.get(key)) is None:
+                histogram = self._histograms[key] = (buckets, [0] * (len(buckets) + 2))
+            counts = histogram[1]
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+        self._start_writer()
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("bettercal_stage_seconds", elapsed, (("stage", stage),))
+            if (trace := _trace.get()) is not None:
+                trace.stages[stage] = trace.stages.get(stage, 0) + elapsed
+
+    def samples(self) -> list[Sample]:
+        with self._lock:
+            samples = [
+                (name, labels, value) for (name, labels), value in self._samples.items()
+            ]
+            for (name, labels), (buckets, counts) in self._histograms.items():
+                samples.extend(histogram_samples(name, labels, buckets, counts))
+        for collector in self.collectors:
+            samples.extend(collector())
+        return samples
+
+    def write(self):
+        """Write the samples of this process to its file in the directory."""
+
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{self._name}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.samples(), f)
+        os.replace(path + ".tmp", path)
+
+    def collect(self) -> list[Sample]:
+        """The samples of all processes that write to the same directory.
+
+        Processes that exited still count, otherwise the counters would go
+        down whenever a worker is restarted.
+        """
+
+        if self.directory is None:
+            return self.samples()
+
+        self.write()
+        totals: dict[tuple[str, Labels], float] = {}
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path) as f:
+                    samples = json.load(f)
+            except OSError:
+                # Removed in the meantime
+                continue
+            for name, labels, value in samples:
+                key = (name, tuple(tuple(label) for label in labels))
+                totals[key] = totals.get(key, 0) + value
+        return [(name, labels, value) for (name, labels), value in totals.items()]
+
+
+def clear_metrics(directory: str | None):
+    """Remove the files of the previous run, call before starting the workers."""
+
+    if directory is None:
+        return
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        os.remove(path)
+
+
+def metric_name(sample_name: str) -> str:
+    for suffix in ["_bucket", "_sum", "_count"]:
+        if sample_name.endswith(suffix) and sample_name[: -len(suffix)] in METRICS:
+            return sample_name[: -len(suffix)]
+    return sample_name
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value: float) -> str:
+    # Large counts would lose digits in the exponent notation
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def sample_order(sample: Sample):
+    # The buckets of a histogram must be in increasing order, +Inf last
+    name, labels, _ = sample
+    rest = tuple(label for label in labels if label[0] != "le")
+    le = dict(labels).get("le")
+    return (rest, name, float(le) if le is not None else 0.0)
+
+
+def to_prometheus(samples: list[Sample]) -> str:
+    """Format the samples in the Prometheus text format."""
+
+    by_metric: dict[str, list[Sample]] = {}
+    for sample in samples:
+        by_metric.setdefault(metric_name(sample[0]), []).append(sample)
+
+    lines = []
+    for metric in sorted(by_metric):
+        kind, description = METRICS.get(metric, ("untyped", ""))
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {kind}")
+
+        for name, labels, value in sorted(by_metric[metric], key=sample_order):
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
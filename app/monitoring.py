@@ -1,15 +1,196 @@
+import atexit
 import hashlib
-from dataclasses import dataclass
-from sqlite3 import Connection
+import os
+import threading
+import time
+import traceback
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import astuple, dataclass
+from datetime import UTC, date, datetime, timedelta
+from sqlite3 import Connection, OperationalError
 
+from app.cache import LRUCache
+from app.sketch import HyperLogLog, merge_all
 
-def add_usage(db: Connection, token: str):
-    hashed_token = hashlib.sha256(token.encode()).hexdigest()
-    db.cursor().execute(
-        "INSERT OR IGNORE INTO statistics_daily (token_hash) VALUES (?)",
-        (hashed_token,),
-    )
-    db.commit()
+# Bump this whenever SCHEMA changes, see app/database.py
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS statistics_daily (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT DEFAULT (DATE('now')),
+    token_hash TEXT NOT NULL,
+    UNIQUE(date, token_hash)
+);
+
+-- The statistics of every day that is over, see update_rollup
+CREATE TABLE IF NOT EXISTS statistics_rollup (
+    date TEXT PRIMARY KEY,
+    daily INTEGER NOT NULL,
+    monthly INTEGER NOT NULL,
+    total INTEGER NOT NULL
+);
+
+-- The first day every user was seen on, until the last day in the rollup
+CREATE TABLE IF NOT EXISTS statistics_first_seen (
+    token_hash TEXT PRIMARY KEY,
+    date TEXT NOT NULL
+);
+
+-- The same as statistics_rollup but estimated, with the sketch of the users of
+-- that day and of all users until then, see update_sketch_rollup
+CREATE TABLE IF NOT EXISTS statistics_sketch_rollup (
+    date TEXT PRIMARY KEY,
+    daily INTEGER NOT NULL,
+    monthly INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    users BLOB NOT NULL,
+    all_users BLOB NOT NULL
+);
+"""
+
+# Write the collected usage at least this often, in seconds
+USAGE_FLUSH_INTERVAL = 10
+# Or as soon as this many new users were collected
+USAGE_FLUSH_SIZE = 1000
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+@dataclass
+class UsageStatistics:
+    recorded: int = 0
+    # Already recorded today by this process, so never sent to the database
+    duplicates: int = 0
+    # Already recorded today by another process
+    ignored_by_db: int = 0
+    written: int = 0
+    pending: int = 0
+    flushes: int = 0
+    failed_flushes: int = 0
+    last_flush_seconds: float = 0
+    max_flush_seconds: float = 0
+    total_flush_seconds: float = 0
+
+
+class UsageRecorder:
+    """Records usage in memory and writes it to the database in batches.
+
+    Every client polls its calendar many times a day, but we only store one row
+    per token and day. So duplicates are dropped right away and the rest is
+    written in a single transaction every USAGE_FLUSH_INTERVAL seconds, instead
+    of a commit on every request. The connections returned by connect are not
+    closed, they belong to whoever opened them.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Connection],
+        interval: float = USAGE_FLUSH_INTERVAL,
+        max_pending: int = USAGE_FLUSH_SIZE,
+    ) -> None:
+        self.connect = connect
+        self.interval = interval
+        self.max_pending = max_pending
+        self.stats = UsageStatistics()
+        self._pending: set[tuple[str, str]] = set()
+        # What is being written right now
+        self._flushing: set[tuple[str, str]] = set()
+        # Everything written today, to drop duplicates before the database
+        self._seen: set[tuple[str, str]] = set()
+        self._seen_date = ""
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher: threading.Thread | None = None
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        # Threads don't survive a fork and the usage belongs to the parent.
+        self._flusher = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = set()
+        self._flushing = set()
+        self.stats = UsageStatistics()
+
+    def record(self, token: str):
+        # The same day as DATE('now') in sqlite
+        key = (datetime.now(UTC).date().isoformat(), hash_token(token))
+        with self._lock:
+            self.stats.recorded += 1
+            if key in self._pending or key in self._flushing or key in self._seen:
+                self.stats.duplicates += 1
+                return
+            self._pending.add(key)
+            if len(self._pending) >= self.max_pending:
+                self._wakeup.set()
+
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_periodically, name="usage-flusher", daemon=True
+                )
+                self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write all collected usage in a single transaction."""
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, set()
+                self._flushing = pending
+            if not pending:
+                return
+
+            start = time.perf_counter()
+            try:
+                db = self.connect()
+                with db:
+                    cursor = db.executemany(
+                        "INSERT OR IGNORE INTO statistics_daily (date, token_hash)"
+                        " VALUES (?, ?)",
+                        sorted(pending),
+                    )
+            except Exception as e:
+                # Try again with the next flush
+                traceback.print_exception(e)
+                with self._lock:
+                    self._pending |= pending
+                    self._flushing = set()
+                    self.stats.failed_flushes += 1
+                return
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                today = max(date for date, _ in pending)
+                if today != self._seen_date:
+                    self._seen = set()
+                    self._seen_date = today
+                self._seen |= {key for key in pending if key[0] == today}
+                self._flushing = set()
+
+                self.stats.written += cursor.rowcount
+                self.stats.ignored_by_db += len(pending) - cursor.rowcount
+                self.stats.flushes += 1
+                self.stats.last_flush_seconds = elapsed
+                self.stats.max_flush_seconds = max(
+                    self.stats.max_flush_seconds, elapsed
+                )
+                self.stats.total_flush_seconds += elapsed
+
+    def statistics(self) -> UsageStatistics:
+        with self._lock:
+            return UsageStatistics(**vars(self.stats) | {"pending": len(self._pending)})
 
 
 @dataclass
@@ -19,62 +200,329 @@ class statistic:
     total_users: int
 
 
-def get_statistics(db: Connection) -> statistic:
-    # Get daily active users
-    cursor = db.cursor()
-    cursor.execute(
-        """SELECT COUNT(*)
-        FROM statistics_daily
-        WHERE date == DATE('now');"""
-    )
-    daily_users = cursor.fetchone()[0]
+# Days are only closed a while after midnight, so that the usage recorded just
+# before it was written by every worker.
+ROLLUP_GRACE = "-5 minutes"
 
-    # Get monthly active users
-    cursor.execute(
-        """SELECT COUNT(DISTINCT token_hash) AS unique_active_users
-        FROM statistics_daily
-        WHERE date >= DATE('now', '-30 days');"""
-    )
-    monthly_users = cursor.fetchone()[0]
+# Estimate the monthly and total users by merging a small sketch of every day,
+# instead of counting them exactly. This takes the same time no matter how many
+# users there are, but is off by about 2%.
+APPROXIMATE_USERS = False
 
-    # Get all users
-    cursor.execute(
-        """SELECT COUNT(DISTINCT token_hash) AS unique_users
-        FROM statistics_daily;"""
-    )
-    total_users = cursor.fetchone()[0]
+# The statistics of days that are not over change with every new user, so they
+# are only recomputed this often, in seconds.
+OPEN_DAY_TTL = 60
 
-    return statistic(daily_users, monthly_users, total_users)
 
+def closed_days(db: Connection, table: str) -> list[str]:
+    """The days that are over but not in the rollup table yet."""
 
-# Only the usage for today will change, so we can cache all past days.
-chart_cache: list[tuple[str, int, int, int]] = []
+    last = db.execute(f"SELECT MAX(date) FROM {table}").fetchone()[0]
+    rows = db.execute(
+        """SELECT DISTINCT date FROM statistics_daily
+        WHERE date > ? AND date < DATE('now', ?)
+        ORDER BY date""",
+        (last or "", ROLLUP_GRACE),
+    ).fetchall()
+    return [day for (day,) in rows]
 
 
-def get_chart_data(db: Connection) -> list[tuple[str, int, int, int]]:
-    global chart_cache
-    since = chart_cache[-1][0] if len(chart_cache) > 0 else None
+@contextmanager
+def immediate(db: Connection) -> Iterator[None]:
+    """A transaction that takes the write lock right away.
+
+    Whatever is read in it can't be changed by another worker before we write.
+    """
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def roll_up(db: Connection, table: str, close_day: Callable[[str], None]):
+    """Close all days that are over, each in its own transaction.
+
+    Every day is its own transaction, so that workers doing this at the same
+    time take turns instead of waiting for the whole history.
+    """
+
+    closed = closed_days(db, table)
+    while closed:
+        try:
+            for day in closed:
+                with immediate(db):
+                    # Another worker might have closed it in the meantime
+                    if db.execute(
+                        f"SELECT 1 FROM {table} WHERE date >= ?", (day,)
+                    ).fetchone():
+                        continue
+                    close_day(day)
+            return
+        except OperationalError as e:
+            # A worker closing many days takes the lock again right after every
+            # one, so the others might not get it before the busy timeout. Keep
+            # waiting for as long as the days get closed.
+            remaining = closed_days(db, table)
+            if e.sqlite_errorname != "SQLITE_BUSY" or len(remaining) >= len(closed):
+                raise
+            closed = remaining
+
+
+def update_rollup(db: Connection):
+    """Add the statistics of all days that are over to the rollup.
+
+    The counts of a day never change once it is over, so every day is computed
+    only once from the rows of that day and the 30 days before.
+    """
+
+    def close_day(day: str):
+        daily, monthly, total = compute_day(db, day)
+        db.execute(
+            """INSERT OR IGNORE INTO statistics_first_seen (token_hash, date)
+            SELECT token_hash, date FROM statistics_daily WHERE date = ?""",
+            (day,),
+        )
+        db.execute(
+            """INSERT OR IGNORE INTO statistics_rollup (date, daily, monthly, total)
+            VALUES (?, ?, ?, ?)""",
+            (day, daily, monthly, total),
+        )
+
+    roll_up(db, "statistics_rollup", close_day)
+
+
+def update_sketch_rollup(db: Connection):
+    """The same as update_rollup, but with the users estimated by sketches."""
+
+    def close_day(day: str):
+        sketch = sketch_day(db, day)
+        db.execute(
+            """INSERT OR IGNORE INTO statistics_sketch_rollup
+            (date, daily, monthly, total, users, all_users)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (
+                day,
+                sketch.daily,
+                sketch.month.count(),
+                sketch.total.count(),
+                sketch.users.to_bytes(),
+                sketch.total.to_bytes(),
+            ),
+        )
 
-    # Fetch the newest data
-    new_data = get_chart_data_since(db, since)
-    result = chart_cache + new_data
+    roll_up(db, "statistics_sketch_rollup", close_day)
 
-    # Update the cache (never store the last day because we don't trust it)
-    # Well the day is not over so it will probably change.
-    chart_cache += new_data[:-1]
 
-    return result
+def compute_day(db: Connection, day: str) -> tuple[int, int, int]:
+    """The daily, monthly and total users of a day that isn't rolled up yet."""
+
+    daily = db.execute(
+        "SELECT COUNT(*) FROM statistics_daily WHERE date = ?", (day,)
+    ).fetchone()[0]
+    monthly = db.execute(
+        """SELECT COUNT(DISTINCT token_hash) FROM statistics_daily
+        WHERE date >= DATE(?, '-30 days') AND date <= ?""",
+        (day, day),
+    ).fetchone()[0]
+
+    # All users until the last closed day, plus the new ones since then
+    last_day, last_total = db.execute(
+        """SELECT date, total FROM statistics_rollup
+        WHERE date < ? ORDER BY date DESC LIMIT 1""",
+        (day,),
+    ).fetchone() or ("", 0)
+    new = db.execute(
+        """SELECT COUNT(DISTINCT token_hash) FROM statistics_daily d
+        WHERE date > ? AND date <= ? AND NOT EXISTS (
+            SELECT 1 FROM statistics_first_seen f WHERE f.token_hash = d.token_hash
+        )""",
+        (last_day, day),
+    ).fetchone()[0]
+    return daily, monthly, last_total + new
+
+
+@dataclass
+class DaySketch:
+    daily: int
+    # The users of that day, of the 30 days before and of all days until then
+    users: HyperLogLog
+    month: HyperLogLog
+    total: HyperLogLog
+
+
+def sketch_day(db: Connection, day: str) -> DaySketch:
+    """The sketches of a day that isn't in the sketch rollup yet.
+
+    The sketches of days in the rollup are merged, only the rows of the days
+    after it are read.
+    """
+
+    daily = db.execute(
+        "SELECT COUNT(*) FROM statistics_daily WHERE date = ?", (day,)
+    ).fetchone()[0]
+    month_start = db.execute("SELECT DATE(?, '-30 days')", (day,)).fetchone()[0]
+    last_day, all_users = db.execute(
+        """SELECT date, all_users FROM statistics_sketch_rollup
+        WHERE date < ? ORDER BY date DESC LIMIT 1""",
+        (day,),
+    ).fetchone() or ("", None)
+    stored = db.execute(
+        """SELECT users FROM statistics_sketch_rollup
+        WHERE date >= ? AND date < ?""",
+        (month_start, day),
+    ).fetchall()
+
+    users = HyperLogLog()
+    month = merge_all(HyperLogLog(users) for (users,) in stored)
+    total = HyperLogLog(all_users)
+    for row_date, token_hash in db.execute(
+        """SELECT date, token_hash FROM statistics_daily
+        WHERE date > ? AND date <= ?""",
+        (last_day, day),
+    ):
+        if row_date == day:
+            users.add(token_hash)
+        elif row_date >= month_start:
+            month.add(token_hash)
+        total.add(token_hash)
+
+    month.merge(users)
+    return DaySketch(daily, users, month, total)
+
+
+def compute_day_approximate(db: Connection, day: str) -> tuple[int, int, int]:
+    sketch = sketch_day(db, day)
+    return sketch.daily, sketch.month.count(), sketch.total.count()
+
+
+_open_day_cache: LRUCache[tuple[str, bool], tuple[int, int, int]] = LRUCache(
+    8, OPEN_DAY_TTL
+)
+
+
+def compute_open_day(
+    db: Connection, day: str, approximate: bool
+) -> tuple[int, int, int]:
+    key = (day, approximate)
+    if (counts := _open_day_cache.get(key)) is not None:
+        return counts
+
+    counts = compute_day_approximate(db, day) if approximate else compute_day(db, day)
+    _open_day_cache.set(key, counts)
+    return counts
+
+
+def get_statistics_version(db: Connection, statistic: statistic) -> str:
+    """Changes once a day with the rollup and whenever today's counts change.
+
+    The statistic has to be the one returned by get_statistics.
+    """
+
+    table = "statistics_sketch_rollup" if APPROXIMATE_USERS else "statistics_rollup"
+    last = db.execute(f"SELECT MAX(date) FROM {table}").fetchone()[0]
+    version = f"{last}:{APPROXIMATE_USERS}:{astuple(statistic)}"
+    return hashlib.sha256(version.encode()).hexdigest()[:32]
+
+
+def get_statistics(db: Connection) -> statistic:
+    today = db.execute("SELECT DATE('now')").fetchone()[0]
+    if APPROXIMATE_USERS:
+        update_sketch_rollup(db)
+    else:
+        update_rollup(db)
+    return statistic(*compute_open_day(db, today, APPROXIMATE_USERS))
+
+
+def get_chart_data(db: Connection) -> list[tuple[str, int, int, int]]:
+    return get_chart_data_since(db)
 
 
 def get_chart_data_since(
-    db: Connection, since: str | None = None
+    db: Connection, since: str | None = None, approximate: bool | None = None
 ) -> list[tuple[str, int, int, int]]:
     if since is None:
         # This is just any day far in the past but, the exact day is just the day before
         # it went into production.
         since = "2023-07-16"
+    if approximate is None:
+        approximate = APPROXIMATE_USERS
+
+    if approximate:
+        update_sketch_rollup(db)
+        table = "statistics_sketch_rollup"
+    else:
+        update_rollup(db)
+        table = "statistics_rollup"
+
+    rows = db.execute(
+        f"""SELECT date, daily, monthly, total FROM {table}
+        WHERE date > ? ORDER BY date""",
+        (since,),
+    ).fetchall()
+
+    # The days that are not over yet
+    last = rows[-1][0] if rows else since
+    open_days = db.execute(
+        f"""SELECT DISTINCT date FROM statistics_daily
+        WHERE date > ? AND date > IFNULL((SELECT MAX(date) FROM {table}), '')
+        ORDER BY date""",
+        (last,),
+    ).fetchall()
+    rows += [(day, *compute_open_day(db, day, approximate)) for (day,) in open_days]
+    return rows
+
+
+CHART_RESOLUTIONS = ("day", "week", "month")
+
+
+def period_start(day: str, resolution: str) -> str:
+    if resolution == "week":
+        start = date.fromisoformat(day)
+        return (start - timedelta(days=start.weekday())).isoformat()
+    if resolution == "month":
+        return day[:7] + "-01"
+    return day
+
+
+def downsample(
+    rows: list[tuple[str, int, int, int]], resolution: str
+) -> list[tuple[str, int, int, int]]:
+    """Combine the days of every week or month into a single row.
+
+    The row is labeled with the first day of the period and has the average of
+    the daily users, but the monthly and total users of its last day.
+    """
+
+    if resolution == "day":
+        return rows
+
+    periods: dict[str, list[tuple[str, int, int, int]]] = {}
+    for row in rows:
+        periods.setdefault(period_start(row[0], resolution), []).append(row)
+    return [
+        (
+            start,
+            round(sum(row[1] for row in days) / len(days)),
+            days[-1][2],
+            days[-1][3],
+        )
+        for start, days in periods.items()
+    ]
+
+
+def get_chart_data_exact(
+    db: Connection, since: str = "2023-07-16"
+) -> list[tuple[str, int, int, int]]:
+    """The same as get_chart_data_since, but computed from all rows every time.
+
+    This gets slower with every day, so it is only the reference to check the
+    rollup against.
+    """
 
-    # Get daily active users
     cursor = db.cursor()
     cursor.execute(
         """
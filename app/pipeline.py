@@ -0,0 +1,338 @@
+import copy
+import hashlib
+import os
+import threading
+import time
+import traceback
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import app.tiss as tiss
+from app.cache import CacheStatistics, FileSingleFlight, LRUCache, SingleFlight
+from app.fastpath import rewrite_calendar
+from app.format import (
+    get_fragment_statistics,
+    get_signup_statistics,
+    improve_calendar,
+    iter_ical,
+    read_courses,
+    read_lecturetube_available_rooms,
+    read_rooms,
+    read_shorthands,
+    resource_version,
+    resources,
+)
+from app.metrics import EVENT_BUCKETS, metrics, note
+from app.timezones import read_timezones, replace_timezones, serialized_timezone
+from app.tiss import UpstreamCalendar
+
+RENDER_CACHE_MAXSIZE = 256
+
+# Rewrite the calendar line by line instead of parsing it. The full parser is
+# still used whenever the fast path fails.
+USE_FAST_PATH = True
+
+# Drop the timezone observances that ended before the first event. Clients only
+# need them for events in that time, but it makes the calendars much smaller.
+COMPACT_TIMEZONES = False
+
+# When serving stale calendars, only ask TISS for a new version if ours is older
+# than this. Younger ones would be served from the upstream cache anyway.
+REFRESH_AFTER = tiss.CACHE_TTL
+
+
+@dataclass(frozen=True)
+class CalendarOptions:
+    locale: str
+    google_cal: bool
+    use_shorthand: bool
+
+
+@dataclass(frozen=True)
+class RenderedCalendar:
+    # The serialized calendar split into components, so that it can be sent
+    # without ever joining it into a single buffer.
+    chunks: tuple[bytes, ...]
+    etag: str
+    events: int
+
+    @property
+    def size(self) -> int:
+        return sum(len(chunk) for chunk in self.chunks)
+
+    @property
+    def body(self) -> bytes:
+        return b"".join(self.chunks)
+
+
+def to_rendered(chunks: Iterable[bytes]) -> RenderedCalendar:
+    digest = hashlib.sha256()
+    collected = []
+    events = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        collected.append(chunk)
+        events += chunk.count(b"BEGIN:VEVENT")
+    return RenderedCalendar(tuple(collected), digest.hexdigest(), events)
+
+
+def finalize(chunks: list[bytes]) -> RenderedCalendar:
+    # Otherwise the timezones are already the ones we would replace them with,
+    # or the same ones as TISS sent them on the fast path.
+    if COMPACT_TIMEZONES:
+        chunks = replace_timezones(chunks, compact=True)
+    return to_rendered(chunks)
+
+
+# A calendar like the ones from TISS, to exercise the code paths once.
+WARM_UP_CALENDAR = """BEGIN:VCALENDAR\r
+PRODID:-//TU Wien//TISS Events//DE\r
+VERSION:2.0\r
+BEGIN:VTIMEZONE\r
+TZID:Europe/Vienna\r
+END:VTIMEZONE\r
+BEGIN:VEVENT\r
+DTSTAMP:20230824T192114Z\r
+DTSTART;TZID=Europe/Vienna:20230526T110000\r
+DTEND;TZID=Europe/Vienna:20230526T130000\r
+SUMMARY:185.208 VU Programming Languages\r
+LOCATION:EI 5 Hochenegg HS\r
+CATEGORIES:COURSE\r
+DESCRIPTION:Lecture\r
+UID:warm-up@tiss.tuwien.ac.at\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+
+
+def warm_up(start_watcher: bool = True):
+    """Load everything we enrich calendars with and render a calendar once.
+
+    Otherwise this happens on the first request, which is then much slower.
+    When called before forking, the workers also share the memory. Then don't
+    start the watcher, every worker has to start its own.
+    """
+
+    with resources.unwatched():
+        resource_version()
+        read_courses()
+        read_shorthands()
+        read_rooms()
+        read_lecturetube_available_rooms()
+        for tzid in read_timezones():
+            serialized_timezone(tzid)
+
+        # Not cached, this isn't a calendar anybody subscribed to
+        for locale in ["de", "en"]:
+            chunks = rewrite_calendar(WARM_UP_CALENDAR, locale=locale)
+            finalize(chunks)
+
+    if start_watcher:
+        resources.start_watcher()
+
+
+_rendered_cache: LRUCache[tuple, RenderedCalendar] = LRUCache(RENDER_CACHE_MAXSIZE)
+
+
+def render_calendar(
+    upstream: UpstreamCalendar, options: CalendarOptions
+) -> RenderedCalendar:
+    # The resources might be reloaded in the meantime, but every calendar
+    # should be rendered with a single version of them.
+    with resources.pinned():
+        return _render_calendar(upstream, options)
+
+
+def _render_calendar(
+    upstream: UpstreamCalendar, options: CalendarOptions
+) -> RenderedCalendar:
+    # The output only depends on the upstream calendar, the options and the
+    # data we use for enrichment.
+    key = (
+        upstream.digest,
+        options.locale,
+        options.google_cal,
+        options.use_shorthand,
+        resource_version(),
+        USE_FAST_PATH,
+        COMPACT_TIMEZONES,
+    )
+    note(upstream_bytes=upstream.size)
+    if (cached := _rendered_cache.get(key)) is not None:
+        note(events=cached.events, cached=True)
+        return cached
+
+    chunks = None
+    if USE_FAST_PATH:
+        try:
+            with metrics.timed("fast_path"):
+                chunks = rewrite_calendar(
+                    upstream.body,
+                    google_cal=options.google_cal,
+                    use_shorthand=options.use_shorthand,
+                    locale=options.locale,
+                )
+        except Exception as e:
+            # Something unusual, let the full parser deal with it.
+            traceback.print_exception(e)
+
+    note(fast_path=chunks is not None)
+    if chunks is None:
+        with metrics.timed("parse"):
+            cal = copy.deepcopy(upstream.calendar)
+        try:
+            with metrics.timed("improve"):
+                cal = improve_calendar(
+                    cal,
+                    google_cal=options.google_cal,
+                    use_shorthand=options.use_shorthand,
+                    locale=options.locale,
+                )
+        except Exception as e:
+            # A error occured during reformatting, print a traceback for loggs but
+            # continue with returning the original calendar.
+            # We don't cache this so that the error shows up on every request.
+            traceback.print_exception(e)
+            rendered = to_rendered(iter_ical(cal))
+            note(events=rendered.events, cached=False)
+            return rendered
+
+        with metrics.timed("serialize"):
+            chunks = list(iter_ical(cal, serialized_timezone))
+
+    with metrics.timed("finalize"):
+        rendered = finalize(chunks)
+    metrics.observe("bettercal_calendar_events", rendered.events, buckets=EVENT_BUCKETS)
+    note(events=rendered.events, cached=False)
+    _rendered_cache.set(key, rendered)
+    return rendered
+
+
+type CalendarKey = tuple[str, CalendarOptions]
+
+# The latest calendar we rendered for every url and options, with the time we
+# fetched it.
+_latest_cache: LRUCache[CalendarKey, tuple[float, RenderedCalendar]] = LRUCache(
+    RENDER_CACHE_MAXSIZE
+)
+
+_refresh_executor: ThreadPoolExecutor | None = None
+_refreshing: set[CalendarKey] = set()
+_refresh_lock = threading.Lock()
+
+
+def _reset_refresh():
+    # Threads don't survive a fork, so every worker needs its own executor.
+    global _refresh_executor, _refresh_lock
+    _refresh_executor = None
+    _refresh_lock = threading.Lock()
+    _refreshing.clear()
+
+
+os.register_at_fork(after_in_child=_reset_refresh)
+
+
+# Concurrent requests for the same calendar share a single fetch and render.
+_inflight: SingleFlight[CalendarKey, RenderedCalendar] = SingleFlight()
+
+
+def _fetch_and_render(
+    url: str, options: CalendarOptions, coalesce_dir: str | None
+) -> RenderedCalendar:
+    if coalesce_dir is None:
+        upstream = tiss.fetch_calendar(url)
+        fetched_at = upstream.fetched_at
+        rendered = render_calendar(upstream, options)
+    else:
+
+        def work() -> bytes:
+            upstream = tiss.fetch_calendar(url)
+            body = render_calendar(upstream, options).body
+            # The others need to know how old it is as well
+            return f"{upstream.fetched_at}\n".encode() + body
+
+        header, _, body = (
+            FileSingleFlight(coalesce_dir).do(f"{url} {options}", work).partition(b"\n")
+        )
+        fetched_at = float(header)
+        rendered = to_rendered((body,))
+
+    _latest_cache.set((url, options), (fetched_at, rendered))
+    return rendered
+
+
+def fetch_and_render(
+    url: str, options: CalendarOptions, coalesce_dir: str | None = None
+) -> RenderedCalendar:
+    """Fetch the calendar from TISS and render it.
+
+    Concurrent calls for the same calendar in this process are coalesced. With
+    a coalesce_dir, this also happens across processes that use the same
+    directory.
+    """
+
+    return _inflight.do(
+        (url, options), lambda: _fetch_and_render(url, options, coalesce_dir)
+    )
+
+
+def _refresh(key: CalendarKey, coalesce_dir: str | None):
+    try:
+        fetch_and_render(*key, coalesce_dir=coalesce_dir)
+    except Exception as e:
+        # The stale calendar stays in the cache so clients still get something.
+        traceback.print_exception(e)
+    finally:
+        with _refresh_lock:
+            _refreshing.discard(key)
+
+
+def _refresh_in_background(
+    url: str, options: CalendarOptions, coalesce_dir: str | None = None
+):
+    global _refresh_executor
+    key = (url, options)
+    with _refresh_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix="refresh"
+            )
+        _refresh_executor.submit(_refresh, key, coalesce_dir)
+
+
+def get_cache_statistics() -> dict[str, CacheStatistics]:
+    return {
+        "upstream": tiss.get_cache_statistics(),
+        "rendered": _rendered_cache.statistics(),
+        "latest": _latest_cache.statistics(),
+        "fragments": get_fragment_statistics(),
+        "signups": get_signup_statistics(),
+    }
+
+
+def get_rendered_calendar(
+    url: str,
+    options: CalendarOptions,
+    max_staleness: float | None = None,
+    coalesce_dir: str | None = None,
+) -> RenderedCalendar:
+    """Get the rendered calendar for the url.
+
+    With a max_staleness (in seconds) a previously rendered calendar that is not
+    older than that is returned right away and refreshed in the background, so
+    that slow responses from TISS don't block the request.
+    """
+
+    if max_staleness is not None and (cached := _latest_cache.get((url, options))):
+        fetched_at, rendered = cached
+        age = time.time() - fetched_at
+        if age <= max_staleness:
+            if age >= REFRESH_AFTER:
+                _refresh_in_background(url, options, coalesce_dir)
+            return rendered
+
+    return fetch_and_render(url, options, coalesce_dir)
@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+import traceback
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+def file_stamp(paths: list[str]) -> tuple:
+    """Changes whenever one of the files is modified or replaced."""
+
+    stamp = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stamp.append(None)
+            continue
+        stamp.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+    return tuple(stamp)
+
+
+class ResourceRegistry[T]:
+    """Holds data loaded from files and reloads it when they change.
+
+    A background thread checks the files every interval seconds and loads the
+    new version while the old one is still served. Swapping them is a single
+    assignment, so readers get either the old or the new one but never a mix.
+    Code that reads the data multiple times, like rendering a calendar, should
+    do so in `pinned` to keep seeing the same version.
+    """
+
+    def __init__(
+        self, paths: list[str], load: Callable[[], T], interval: float | None = 30
+    ) -> None:
+        self.paths = paths
+        self.load = load
+        self.interval = interval
+        self.reloads = 0
+        self._current: tuple[tuple, T] | None = None
+        self._pinned: ContextVar[T | None] = ContextVar("pinned", default=None)
+        self._lock = threading.Lock()
+        self._watcher: threading.Thread | None = None
+        self._unwatched = False
+        os.register_at_fork(after_in_child=self._reset_watcher)
+
+    def _reset_watcher(self):
+        # Threads don't survive a fork, so every worker starts its own.
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    def start_watcher(self):
+        """Check the files in the background, `get` does this on first use."""
+
+        if self.interval is None or self._unwatched or self._watcher is not None:
+            return
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(
+                    target=self._watch, name="resource-watcher", daemon=True
+                )
+                self._watcher.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)  # type: ignore
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                # Keep serving the old version, maybe the files are still being
+                # written.
+                traceback.print_exception(e)
+
+    def reload_if_changed(self) -> bool:
+        stamp = file_stamp(self.paths)
+        if self._current is not None and self._current[0] == stamp:
+            return False
+
+        with self._lock:
+            if self._current is not None and self._current[0] == stamp:
+                return False
+            value = self.load()
+            if self._current is not None:
+                self.reloads += 1
+            self._current = (stamp, value)
+        return True
+
+    def get(self) -> T:
+        """The pinned version if there is one, otherwise the latest."""
+
+        if (pinned := self._pinned.get()) is not None:
+            return pinned
+
+        if self._current is None:
+            self.reload_if_changed()
+        self.start_watcher()
+        return self._current[1]  # type: ignore
+
+    @contextmanager
+    def unwatched(self) -> Iterator[None]:
+        """Load without starting the watcher, e.g. in a process that forks.
+
+        Threads don't survive a fork and forking while they run can deadlock.
+        """
+
+        self._unwatched = True
+        try:
+            yield
+        finally:
+            self._unwatched = False
+
+    @contextmanager
+    def pinned(self) -> Iterator[T]:
+        token = self._pinned.set(self.get())
+        try:
+            yield self._pinned.get()  # type: ignore
+        finally:
+            self._pinned.reset(token)
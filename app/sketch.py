@@ -0,0 +1,70 @@
+import hashlib
+import math
+from collections.abc import Iterable
+
+# 2^12 registers of one byte each, the standard error is about 1.04 / 64 = 1.6%
+SKETCH_PRECISION = 12
+SKETCH_REGISTERS = 1 << SKETCH_PRECISION
+
+_ALPHA = 0.7213 / (1 + 1.079 / SKETCH_REGISTERS)
+_INVERSE_POWERS = [2.0**-rank for rank in range(65)]
+_BITS = 64 - SKETCH_PRECISION
+
+
+class HyperLogLog:
+    """Estimates the number of distinct values in a fixed amount of memory.
+
+    Sketches of different sets can be merged into the sketch of their union, so
+    the users of a month are the merge of the sketches of its days.
+    """
+
+    __slots__ = ("registers",)
+
+    def __init__(self, registers: bytes | None = None) -> None:
+        if registers is not None and len(registers) != SKETCH_REGISTERS:
+            raise ValueError(f"A sketch has {SKETCH_REGISTERS} registers")
+        self.registers = bytearray(registers or SKETCH_REGISTERS)
+
+    @classmethod
+    def of(cls, values: Iterable[str]) -> "HyperLogLog":  # noqa: UP037
+        sketch = cls()
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+    def add(self, value: str):
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest())
+        index = hashed >> _BITS
+        rank = _BITS - (hashed & ((1 << _BITS) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):  # noqa: UP037
+        self.registers = bytearray(
+            map(max, zip(self.registers, other.registers, strict=True))
+        )
+
+    def count(self) -> int:
+        estimate = (
+            _ALPHA
+            * SKETCH_REGISTERS
+            * SKETCH_REGISTERS
+            / sum(_INVERSE_POWERS[rank] for rank in self.registers)
+        )
+
+        # Small sets leave registers empty, for which linear counting is better
+        if estimate <= 2.5 * SKETCH_REGISTERS:
+            empty = self.registers.count(0)
+            if empty:
+                estimate = SKETCH_REGISTERS * math.log(SKETCH_REGISTERS / empty)
+        return round(estimate)
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+
+def merge_all(sketches: Iterable[HyperLogLog]) -> HyperLogLog:
+    merged = HyperLogLog()
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
@@ -9,7 +9,6 @@ function drawStatisticsChart(displayData) {
   Chart.defaults.borderColor = "rgba(255, 255, 255, 0.2)";
   Chart.defaults.color = "#FFF";
 
-  console.log(displayData);
   let labels = displayData.map(([l, d, m, t]) => l);
   let daily = displayData.map(([l, d, m, t]) => d);
   let monthly = displayData.map(([l, d, m, t]) => m);
@@ -58,16 +57,44 @@ function drawStatisticsChart(displayData) {
 }
 
 const lastMonthCheck = document.getElementById("last-month");
+const resolutionSelect = document.getElementById("resolution");
 lastMonthCheck.addEventListener("change", render);
+resolutionSelect.addEventListener("change", render);
 
-function render() {
+// The server only sends the history in the resolution that is shown, so every
+// series is fetched once when it is needed.
+const series = {};
+
+function fetchSeries(query) {
+  if (!(query in series)) {
+    series[query] = fetch(`/statistics/chart?${query}`).then((response) =>
+      response.json(),
+    );
+  }
+  return series[query];
+}
+
+function lastMonthStart() {
+  const date = new Date();
+  date.setDate(date.getDate() - 31);
+  return date.toISOString().slice(0, 10);
+}
+
+let renders = 0;
+
+async function render() {
+  const current = ++renders;
+  let query;
   if (lastMonthCheck.checked) {
-    // only last 30 days
-    drawStatisticsChart(chart_data.slice(Math.max(chart_data.length - 30, 0)));
+    // only last 30 days, always every day
+    query = `since=${lastMonthStart()}&resolution=day`;
   } else {
-    // original
-    drawStatisticsChart(chart_data);
+    query = `resolution=${resolutionSelect.value}`;
   }
+  resolutionSelect.disabled = lastMonthCheck.checked;
+  const data = await fetchSeries(query);
+  // Another series might have been picked while this one was loading
+  if (current === renders) drawStatisticsChart(data);
 }
 
 render();
@@ -0,0 +1,117 @@
+"""Swap the timezones in calendars for pre-serialized ones.
+
+Every TISS calendar carries the complete history of Europe/Vienna back to 1893.
+For the timezones we know, we serialize them once and reuse the bytes for every
+calendar. In compact mode we also drop the observances that ended before the
+first event, which no client will ever need.
+"""
+
+import re
+from datetime import datetime
+from functools import lru_cache
+
+import icalendar
+
+from app.format import resource_version
+
+TIMEZONE_FILE = "app/resources/timezones.ics"
+
+tzid_regex = re.compile(rb"^TZID:([^\r\n]*)\r?$", re.MULTILINE)
+dtstart_regex = re.compile(rb"^DTSTART(?:;[^:\r\n]*)?:(\d{4})", re.MULTILINE)
+
+
+def read_timezones() -> dict[str, icalendar.Timezone]:
+    return _read_timezones(resource_version())
+
+
+# The file is one of the resources, so it is reloaded with them. Calendars that
+# are still rendered with the old version might need it during a reload.
+@lru_cache(maxsize=2)
+def _read_timezones(version: str) -> dict[str, icalendar.Timezone]:
+    with open(TIMEZONE_FILE, "rb") as f:
+        cal = icalendar.Calendar.from_ical(f.read())
+    return {
+        str(tz["TZID"]): tz
+        for tz in cal.walk("VTIMEZONE")
+        if isinstance(tz, icalendar.Timezone)
+    }
+
+
+def last_onset(observance: icalendar.Component) -> datetime:
+    """The last time this observance starts, datetime.max if it never ends."""
+
+    rrule = observance.get("RRULE")
+    if rrule is not None:
+        if "UNTIL" not in rrule:
+            return datetime.max
+        return rrule["UNTIL"][0].replace(tzinfo=None)
+
+    onsets = [observance["DTSTART"].dt]
+    rdates = observance.get("RDATE", [])
+    if not isinstance(rdates, list):
+        rdates = [rdates]
+    for rdate in rdates:
+        onsets.extend(d.dt for d in rdate.dts)
+    return max(onset.replace(tzinfo=None) for onset in onsets)
+
+
+def compact_timezone(tz: icalendar.Timezone, since_year: int) -> icalendar.Timezone:
+    """Drop all observances that ended before since_year.
+
+    The last one that ended before is kept, as it might still be in effect at
+    the start of the year.
+    """
+
+    cutoff = datetime(since_year, 1, 1)
+    observances = [(last_onset(o), o) for o in tz.subcomponents]
+    before = [onset for onset, _ in observances if onset < cutoff]
+    keep_from = max(before, default=cutoff)
+
+    compact = icalendar.Timezone(tz)
+    compact.subcomponents = [o for onset, o in observances if onset >= keep_from]
+    return compact
+
+
+def serialized_timezone(tzid: str, since_year: int | None = None) -> bytes | None:
+    """The pre-serialized timezone, None if we don't know it."""
+
+    return _serialized_timezone(tzid, since_year, resource_version())
+
+
+@lru_cache(maxsize=256)
+def _serialized_timezone(
+    tzid: str, since_year: int | None, version: str
+) -> bytes | None:
+    tz = _read_timezones(version).get(tzid)
+    if tz is None:
+        return None
+    if since_year is not None:
+        tz = compact_timezone(tz, since_year)
+    return tz.to_ical()
+
+
+def replace_timezones(chunks: list[bytes], compact: bool = False) -> list[bytes]:
+    """Replace every known timezone in the serialized calendar.
+
+    The chunks must contain one component each, like the ones of
+    rewrite_calendar and iter_ical. Unknown timezones are left as they are.
+    """
+
+    since_year = None
+    if compact:
+        years = [
+            int(year)
+            for chunk in chunks
+            if chunk.startswith(b"BEGIN:VEVENT")
+            for year in dtstart_regex.findall(chunk)
+        ]
+        since_year = min(years, default=None)
+
+    replaced = []
+    for chunk in chunks:
+        if chunk.startswith(b"BEGIN:VTIMEZONE") and (match := tzid_regex.search(chunk)):
+            block = serialized_timezone(match.group(1).decode(), since_year)
+            if block is not None:
+                chunk = block
+        replaced.append(chunk)
+    return replaced
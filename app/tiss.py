@@ -1,8 +1,227 @@
+import hashlib
+import os
+import threading
+import time
+from collections.abc import Mapping
+from dataclasses import dataclass, field, replace
+from functools import cached_property
+from typing import TYPE_CHECKING
+
 import requests
 from icalendar import Calendar, Component
+from requests.adapters import HTTPAdapter
+
+from app.cache import CacheStatistics, LRUCache
+from app.metrics import metrics
+
+if TYPE_CHECKING:
+    # Only installed with the async extra
+    import httpx
+
+# Connecting to TISS should be fast, but rendering large calendars on their side
+# can take a while.
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 20
+
+# All requests go to the same host, so we only need a single pool per worker,
+# but it must be large enough for every thread that might fetch concurrently.
+POOL_MAXSIZE = 16
+
+# Schedules rarely change, so calendars are served from memory for a few minutes
+# and revalidated with TISS afterwards.
+CACHE_TTL = 5 * 60
+CACHE_MAXSIZE = 256
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def _reset_session():
+    # Sockets must not be shared between gunicorn workers, so every forked
+    # process starts with a fresh pool.
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_session)
+
+
+@dataclass(frozen=True)
+class UpstreamCalendar:
+    body: str
+    digest: str
+    etag: str | None
+    last_modified: str | None
+    # When TISS sent this version or last confirmed that it is still current
+    fetched_at: float = field(default_factory=time.time)
+
+    @cached_property
+    def size(self) -> int:
+        """The size of the body in bytes, as TISS sent it."""
+        return len(self.body.encode())
+
+    @cached_property
+    def calendar(self) -> Component:
+        """The parsed calendar, only needed if the fast path can't be used.
+
+        Shared between requests, so it must never be modified.
+        """
+        return Calendar.from_ical(self.body)
+
+
+# The url contains the token and the locale, which identify a calendar.
+_calendar_cache: LRUCache[str, UpstreamCalendar] = LRUCache(CACHE_MAXSIZE, CACHE_TTL)
+
+
+def _revalidation_headers(stale: UpstreamCalendar | None) -> dict[str, str]:
+    # Revalidate an expired entry instead of downloading it again.
+    headers = {}
+    if stale is not None:
+        if stale.etag is not None:
+            headers["If-None-Match"] = stale.etag
+        if stale.last_modified is not None:
+            headers["If-Modified-Since"] = stale.last_modified
+    return headers
+
+
+def _store_calendar(url: str, body: str, headers: Mapping[str, str]):
+    upstream = UpstreamCalendar(
+        body=body,
+        digest=hashlib.sha256(body.encode()).hexdigest(),
+        etag=headers.get("ETag"),
+        last_modified=headers.get("Last-Modified"),
+    )
+    _calendar_cache.set(url, upstream)
+    return upstream
+
+
+def _store_revalidated(url: str, stale: UpstreamCalendar) -> UpstreamCalendar:
+    upstream = replace(stale, fetched_at=time.time())
+    # It is the same calendar, so it doesn't need to be parsed again
+    if "calendar" in stale.__dict__:
+        upstream.__dict__["calendar"] = stale.calendar
+    _calendar_cache.set(url, upstream)
+    return upstream
+
+
+def _count_error(error: Exception):
+    kind = type(error).__name__
+    if (response := getattr(error, "response", None)) is not None:
+        # Rejected tokens and TISS being down are quite different
+        kind = f"{kind} {response.status_code}"
+    metrics.inc("bettercal_upstream_errors_total", (("type", kind),))
+
+
+def get_cache_statistics() -> CacheStatistics:
+    return _calendar_cache.statistics()
+
+
+def fetch_calendar(url: str) -> UpstreamCalendar:
+    if (cached := _calendar_cache.get(url)) is not None:
+        return cached
+
+    stale = _calendar_cache.get_stale(url)
+    try:
+        with metrics.timed("fetch"):
+            resp = get_session().get(
+                url,
+                headers=_revalidation_headers(stale),
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            )
+        if stale is not None and resp.status_code == 304:
+            return _store_revalidated(url, stale)
+        resp.raise_for_status()
+    except Exception as e:
+        _count_error(e)
+        raise
+
+    return _store_calendar(url, resp.text, resp.headers)
+
+
+async def fetch_calendar_async(
+    url: str,
+    client: "httpx.AsyncClient",  # noqa: UP037
+) -> UpstreamCalendar:
+    """The same as fetch_calendar but with an async client.
+
+    Both share the same cache.
+    """
+
+    if (cached := _calendar_cache.get(url)) is not None:
+        return cached
+
+    stale = _calendar_cache.get_stale(url)
+    try:
+        with metrics.timed("fetch"):
+            resp = await client.get(url, headers=_revalidation_headers(stale))
+        if stale is not None and resp.status_code == 304:
+            return _store_revalidated(url, stale)
+        resp.raise_for_status()
+    except Exception as e:
+        _count_error(e)
+        raise
+
+    return _store_calendar(url, resp.text, resp.headers)
+
+
+@dataclass
+class PoolStatistics:
+    requests: int
+    connections: int
+    reuse_rate: float
+    active_connections: int
+    idle_connections: int
+
+
+def get_pool_statistics() -> PoolStatistics:
+    """Statistics of the connection pools of this worker.
+
+    The reuse rate is the fraction of requests that didn't need to open a new
+    connection, so if keep-alive works it should be close to one.
+    """
+
+    requests_cnt = connections = active = idle = 0
+    session = _session
+    if session is not None:
+        # The same adapter might be mounted for multiple prefixes
+        adapters = {id(a): a for a in session.adapters.values()}
+        for adapter in adapters.values():
+            if not isinstance(adapter, HTTPAdapter):
+                continue
 
+            # The container of pools doesn't support iterating directly
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():  # noqa: SIM118
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_cnt += pool.num_requests
+                connections += pool.num_connections
+                if pool.pool is None:
+                    continue
+                # The queue holds idle connections and placeholders (None) for
+                # connections that were never opened. Everything missing from
+                # the queue is currently checked out.
+                queued = list(pool.pool.queue)
+                idle += sum(1 for conn in queued if conn is not None)
+                active += pool.pool.maxsize - len(queued)
 
-def get_calendar(url: str) -> Component:
-    resp = requests.get(url)
-    resp.raise_for_status()
-    return Calendar.from_ical(resp.text)
+    reuse_rate = 1 - connections / requests_cnt if requests_cnt > 0 else 0.0
+    return PoolStatistics(requests_cnt, connections, reuse_rate, active, idle)
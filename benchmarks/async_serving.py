@@ -0,0 +1,158 @@
+"""Compare the sync gunicorn workers with the asyncio server.
+
+A fake TISS answers every calendar request after a fixed delay, so the
+servers mostly wait for I/O. Every request uses another token, so nothing is
+served from the upstream cache.
+
+    uv run --extra async -- python benchmarks/async_serving.py
+"""
+
+import argparse
+import asyncio
+import http.server
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fake_tiss(delay: float) -> int:
+    with open("tests/calendar_en.ics", "rb") as f:
+        body = f.read()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/calendar")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(http.server.ThreadingHTTPServer):
+        # The async server opens a lot of connections at once
+        request_queue_size = 1024
+
+    port = free_port()
+    server = Server(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return port
+
+
+def wait_until_up(port: int):
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/")
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError("Server didn't start")
+
+
+async def load(port: int, requests: int, concurrency: int) -> tuple[list[float], int]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async with httpx.AsyncClient(
+        timeout=120, limits=httpx.Limits(max_connections=concurrency)
+    ) as client:
+
+        async def one(i: int):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    resp = await client.get(
+                        f"http://127.0.0.1:{port}/personal.ics",
+                        params={"token": f"benchmark{i}", "locale": "en"},
+                    )
+                    resp.raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(one(i) for i in range(requests)))
+
+    return latencies, errors
+
+
+def run(name: str, command: list[str], env: dict, port: int, args) -> None:
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_up(port)
+        start = time.perf_counter()
+        latencies, errors = asyncio.run(load(port, args.requests, args.concurrency))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    print(
+        f"{name:<28} {args.requests / elapsed:8.1f} req/s"
+        f"  p50 {statistics.median(latencies) * 1000:7.0f} ms"
+        f"  p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.0f} ms"
+        f"  errors {errors}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--delay", type=float, default=0.5, help="TISS latency")
+    parser.add_argument("--workers", type=int, default=5)
+    args = parser.parse_args()
+
+    tiss_port = start_fake_tiss(args.delay)
+    env = os.environ | {
+        "FLASK_TISS_CALENDAR_URL": f"http://127.0.0.1:{tiss_port}/calendar"
+    }
+    print(
+        f"{args.requests} requests, {args.concurrency} concurrent,"
+        f" TISS latency {args.delay * 1000:.0f} ms"
+    )
+
+    port = free_port()
+    run(
+        f"gunicorn sync, {args.workers} workers",
+        [
+            *(sys.executable, "-m", "gunicorn"),
+            *("-w", str(args.workers), "--bind", f"127.0.0.1:{port}", "app:app"),
+        ],
+        env,
+        port,
+        args,
+    )
+
+    port = free_port()
+    run(
+        "uvicorn async, 1 process",
+        [sys.executable, "-m", "uvicorn", "--port", str(port), "app.asgi:app"],
+        env,
+        port,
+        args,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Measure the cost per event of enriching a semester-sized calendar.
+
+The test calendar is repeated, like a semester in which every lecture happens
+every week, and the cost per event is reported with and without memoizing the
+enrichment of repeating lectures.
+
+    uv run python benchmarks/enrichment.py
+"""
+
+import argparse
+import copy
+import re
+import time
+
+import icalendar
+
+from app.fastpath import enrich_lines, rewrite_calendar
+from app.format import (
+    enrich_event,
+    enrich_event_memoized,
+    improve_calendar,
+    iter_ical,
+    summary_regex,
+)
+
+event_regex = re.compile(r"BEGIN:VEVENT\r\n.*?END:VEVENT\r\n", re.DOTALL)
+
+
+def semester_calendar(weeks: int) -> str:
+    with open("tests/calendar_de.ics", newline="") as f:
+        body = f.read()
+
+    events = "".join(
+        event.replace("UID:", f"UID:week{week}-")
+        for week in range(weeks)
+        for event in event_regex.findall(body)
+    )
+    start = event_regex.search(body).start()  # type: ignore
+    end = body.rindex("END:VCALENDAR")
+    return body[:start] + events + body[end:]
+
+
+def per_event(name: str, events: int, fn, runs: int):
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    elapsed = (time.perf_counter() - start) / runs
+    print(f"{name:<36} {elapsed * 1_000_000 / events:7.1f} µs/event")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weeks", type=int, default=6)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    body = semester_calendar(args.weeks)
+    cal = icalendar.Calendar.from_ical(body)
+    lectures = [
+        event
+        for event in cal.walk("VEVENT")
+        if summary_regex.match(event.get("summary"))
+    ]
+    properties = [
+        {
+            name: str(event[name])
+            for name in ["summary", "location", "description"]
+            if name in event
+        }
+        for event in lectures
+    ]
+    distinct = {tuple(p.values()) for p in properties}
+    print(f"{len(lectures)} lectures, {len(distinct)} distinct\n")
+
+    def enrich():
+        for event in lectures:
+            enrich_event(event, True, False, "de")
+
+    def enrich_memoized():
+        memo = {}
+        for event in lectures:
+            enrich_event_memoized(memo, event, True, False, "de")
+
+    def lines():
+        for p in properties:
+            enrich_lines(p, True, False, "de")
+
+    def lines_memoized():
+        memo = {}
+        for p in properties:
+            key = tuple(p.values())
+            if key not in memo:
+                memo[key] = enrich_lines(p, True, False, "de")
+
+    per_event("enrich_event", len(lectures), enrich, args.runs)
+    per_event("enrich_event, memoized", len(lectures), enrich_memoized, args.runs)
+    per_event("enrich and serialize", len(lectures), lines, args.runs)
+    per_event(
+        "enrich and serialize, memoized", len(lectures), lines_memoized, args.runs
+    )
+    print()
+    per_event(
+        "full parser, whole calendar",
+        len(lectures),
+        lambda: b"".join(iter_ical(improve_calendar(copy.deepcopy(cal)))),
+        args.runs,
+    )
+    per_event(
+        "fast path, whole calendar",
+        len(lectures),
+        lambda: rewrite_calendar(body),
+        args.runs,
+    )
+
+
+if __name__ == "__main__":
+    main()
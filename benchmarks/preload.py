@@ -0,0 +1,106 @@
+"""Compare gunicorn with and without preloading the app in the master.
+
+Reports the latency of the very first calendar request and the memory of the
+workers once all of them served calendars. Pss splits shared pages between
+the processes sharing them, so it shows what a worker really costs.
+
+    uv run --extra async -- python benchmarks/preload.py
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from async_serving import free_port, start_fake_tiss, wait_until_up
+
+
+def memory(pid: int) -> dict[str, int]:
+    """Rss and Pss of the process in KiB."""
+
+    result = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("Rss", "Pss"):
+                result[name] = int(value.split()[0])
+    return result
+
+
+def workers(pid: int) -> list[int]:
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def calendar(client: httpx.Client, port: int, i: int) -> float:
+    start = time.perf_counter()
+    client.get(
+        f"http://127.0.0.1:{port}/personal.ics",
+        params={"token": f"benchmark{i}", "locale": "en"},
+    ).raise_for_status()
+    return time.perf_counter() - start
+
+
+def run(name: str, config: str, env: dict, args):
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            *(sys.executable, "-m", "gunicorn", "-c", config),
+            *("-w", str(args.workers), "--bind", f"127.0.0.1:{port}", "app:app"),
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    # Creating a client is slow too, which we don't want to measure
+    client = httpx.Client(timeout=60)
+    try:
+        wait_until_up(port)
+        while len(workers(server.pid)) < args.workers:
+            time.sleep(0.1)
+        # Without preloading, the workers might still import the app
+        time.sleep(2)
+
+        first = calendar(client, port, 0)
+        # Enough requests that every worker served a few calendars
+        with ThreadPoolExecutor(args.workers * 2) as executor:
+            list(
+                executor.map(
+                    lambda i: calendar(client, port, i), range(1, args.requests)
+                )
+            )
+
+        usage = [memory(pid) for pid in workers(server.pid)]
+    finally:
+        client.close()
+        server.terminate()
+        server.wait()
+
+    print(
+        f"{name:<12} first request {first * 1000:6.0f} ms"
+        f"  worker Rss {statistics.mean(u['Rss'] for u in usage) / 1024:5.1f} MiB"
+        f"  Pss {statistics.mean(u['Pss'] for u in usage) / 1024:5.1f} MiB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=100)
+    args = parser.parse_args()
+
+    tiss_port = start_fake_tiss(0)
+    env = os.environ | {
+        "FLASK_TISS_CALENDAR_URL": f"http://127.0.0.1:{tiss_port}/calendar"
+    }
+
+    run("no preload", "/dev/null", env, args)
+    run("preload", "gunicorn.conf.py", env, args)
+
+
+if __name__ == "__main__":
+    main()
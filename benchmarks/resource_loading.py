@@ -0,0 +1,60 @@
+"""Compare loading the resources from the CSVs with the compiled bundle.
+
+Every run starts a new interpreter, like a freshly forked gunicorn worker that
+serves its first calendar.
+
+    uv run python benchmarks/resource_loading.py
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+
+LOAD = """
+import time
+import app.format as format
+format.BUNDLE_FILE = {bundle!r}
+start = time.perf_counter()
+# Needed for the first calendar anyway, and to validate the bundle
+format.resource_version()
+format.read_courses()
+format.read_shorthands()
+format.read_rooms()
+format.read_lecturetube_available_rooms()
+print(time.perf_counter() - start)
+"""
+
+
+def measure(bundle: str, runs: int) -> list[float]:
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-c", LOAD.format(bundle=bundle)], text=True
+        )
+        timings.append(float(output))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    from app.format import compile_resources
+
+    with tempfile.TemporaryDirectory() as directory:
+        bundle = f"{directory}/bundle.pickle"
+        for name, path in [("csv", f"{directory}/missing"), ("bundle", bundle)]:
+            if name == "bundle":
+                compile_resources(bundle)
+            timings = measure(path, args.runs)
+            print(
+                f"{name:<8} median {statistics.median(timings) * 1000:6.1f} ms"
+                f"  min {min(timings) * 1000:6.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
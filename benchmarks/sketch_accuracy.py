@@ -0,0 +1,91 @@
+"""Compare the user counts estimated by sketches with the exact ones.
+
+A synthetic history is generated, in which every user starts on a random day,
+uses the calendar on some of the following days and eventually stops. The
+report lists how far the estimated monthly and total users are off, and how
+long both ways take.
+
+    uv run python benchmarks/sketch_accuracy.py
+"""
+
+import argparse
+import random
+import sqlite3
+import statistics
+import time
+from datetime import UTC, datetime, timedelta
+
+from app.monitoring import SCHEMA, get_chart_data_since, hash_token
+
+
+def synthetic_history(days: int, users: int, seed: int) -> list[tuple[str, str]]:
+    rng = random.Random(seed)
+    today = datetime.now(UTC).date()
+    rows = []
+    for user in range(users):
+        token_hash = hash_token(f"user{user}")
+        start = rng.randrange(days)
+        length = int(rng.expovariate(1 / 120))
+        activity = rng.uniform(0.1, 0.8)
+        for day in range(start, min(start + length, days)):
+            if rng.random() < activity:
+                date = today - timedelta(days=days - 1 - day)
+                rows.append((date.isoformat(), token_hash))
+    return rows
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def report(name: str, exact: list[int], estimated: list[int]):
+    errors = [
+        abs(e - x) / x * 100 for x, e in zip(exact, estimated, strict=True) if x > 0
+    ]
+    print(
+        f"{name:<8} mean {statistics.mean(errors):5.2f}%  "
+        f"p95 {statistics.quantiles(errors, n=20)[-1]:5.2f}%  "
+        f"max {max(errors):5.2f}%"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    db = sqlite3.connect(":memory:")
+    db.executescript(SCHEMA)
+    rows = synthetic_history(args.days, args.users, args.seed)
+    db.executemany(
+        "INSERT INTO statistics_daily (date, token_hash) VALUES (?, ?)", rows
+    )
+    db.commit()
+    print(f"{len(rows)} rows over {args.days} days\n")
+
+    exact, exact_first = timed(lambda: get_chart_data_since(db, approximate=False))
+    _, exact_after = timed(lambda: get_chart_data_since(db, approximate=False))
+    estimated, estimated_first = timed(
+        lambda: get_chart_data_since(db, approximate=True)
+    )
+    _, estimated_after = timed(lambda: get_chart_data_since(db, approximate=True))
+
+    assert [row[:2] for row in exact] == [row[:2] for row in estimated]
+    report("monthly", [row[2] for row in exact], [row[2] for row in estimated])
+    report("total", [row[3] for row in exact], [row[3] for row in estimated])
+
+    print()
+    print(f"{'':<8} {'first rollup':>14} {'afterwards':>12}")
+    print(f"{'exact':<8} {exact_first * 1000:11.1f} ms {exact_after * 1000:9.1f} ms")
+    print(
+        f"{'sketch':<8} {estimated_first * 1000:11.1f} ms "
+        f"{estimated_after * 1000:9.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
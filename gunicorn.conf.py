@@ -0,0 +1,40 @@
+# Gunicorn picks this up automatically when started from the repository.
+import gc
+
+# Load the app in the master before forking the workers, so that they share
+# the memory of everything loaded by then.
+preload_app = True
+
+
+def when_ready(server):
+    from app import app
+    from app.metrics import clear_metrics, metrics
+    from app.pipeline import warm_up
+
+    # The counters of the last run would otherwise be added to the new ones
+    clear_metrics(app.config["METRICS_DIR"])
+    # Only the workers serve requests, so only they write their metrics.
+    metrics.directory = None
+    # Forking a process with threads can deadlock, the workers start them.
+    warm_up(start_watcher=False)
+    # The garbage collector of the workers would otherwise touch all of these
+    # objects and with that copy the memory they share.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import app
+    from app.format import resources
+    from app.metrics import metrics
+
+    metrics.directory = app.config["METRICS_DIR"]
+    resources.start_watcher()
+
+
+def worker_exit(server, worker):
+    from app import usage_recorder
+    from app.metrics import metrics
+
+    # Don't lose the usage that was not written yet
+    usage_recorder.flush()
+    metrics.write()
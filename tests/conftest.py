@@ -19,6 +19,13 @@ def app():
     yield app
 
 
+@pytest.fixture()
+def full_parser(monkeypatch):
+    # The snapshots are the output of the full parser, the fast path is compared
+    # against them in test_fastpath.py
+    monkeypatch.setattr("app.pipeline.USE_FAST_PATH", False)
+
+
 @pytest.fixture()
 def client(app) -> FlaskClient:
     return app.test_client()
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from tests.test_request import get_test_upstream
+
+httpx = pytest.importorskip("httpx")
+asgi = pytest.importorskip("app.asgi")
+
+
+def get(path: str, headers: dict | None = None):
+    async def run():
+        transport = httpx.ASGITransport(app=asgi.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://testserver"
+        ) as client:
+            return await client.get(path, headers=headers)
+
+    return asyncio.run(run())
+
+
+def test_async_icalendar_matches_sync(app, client, mocker):
+    upstream = get_test_upstream(lang="en")
+    mocker.patch("app.tiss.fetch_calendar", return_value=upstream)
+    mocker.patch("app.tiss.fetch_calendar_async", return_value=upstream)
+    mocker.patch("app.asgi.usage_recorder")
+
+    url = "/personal.ics?locale=en&token=justATestingTokenObviouslyNotReal&google"
+    response = get(url)
+
+    assert response.status_code == 200
+    assert response.content == client.get(url).data
+
+    response = get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+
+def test_async_icalendar_missing_token(app):
+    response = get("/personal.ics?locale=en")
+    assert response.status_code == 400
+
+
+def test_async_verify_not_tiss_url(app):
+    response = get("/verify?url=https://example.com")
+    assert response.status_code == 400
+
+
+def test_async_falls_back_to_flask(app):
+    response = get("/")
+    assert response.status_code == 200
+    assert b"Original calendar url" in response.content
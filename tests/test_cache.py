@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+from app.cache import CacheStatistics, FileSingleFlight, LRUCache, SingleFlight
+
+
+def test_lru_cache_evicts_oldest():
+    cache: LRUCache[str, int] = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_lru_cache_expires():
+    cache: LRUCache[str, int] = LRUCache(maxsize=2, ttl=0)
+    cache.set("a", 1)
+
+    assert cache.get("a") is None
+    assert cache.get_stale("a") == 1
+
+
+def test_lru_cache_counts_per_process():
+    cache: LRUCache[str, int] = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+
+    # What happens in a worker after the fork
+    cache._reset()
+
+    # It keeps the entries but not the counts of the master
+    assert cache.statistics() == CacheStatistics(1, 2, 0, 0)
+    assert cache.get("a") == 1
+
+
+def test_single_flight_coalesces():
+    flight: SingleFlight[str, int] = SingleFlight()
+    started = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return 42
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("a", work)))
+    leader.start()
+    started.wait()
+    results.append(flight.do("a", work))
+    leader.join()
+
+    assert results == [42, 42]
+    assert len(calls) == 1
+    assert flight.shared == 1
+
+
+def test_file_single_flight_coalesces(tmp_path):
+    started = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return b"result"
+
+    # Separate instances behave like separate processes, as each opens the
+    # lock file itself.
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(FileSingleFlight(str(tmp_path)).do("a", work))
+    )
+    leader.start()
+    started.wait()
+    results.append(FileSingleFlight(str(tmp_path)).do("a", work))
+    leader.join()
+
+    assert results == [b"result", b"result"]
+    assert len(calls) == 1
+
+
+def test_file_single_flight_only_stores_awaited_results(tmp_path):
+    flight = FileSingleFlight(str(tmp_path / "coalesce"))
+    assert flight.do("a", lambda: b"result") == b"result"
+    assert not list((tmp_path / "coalesce").glob("*.result"))
+
+
+def test_file_single_flight_rejects_shared_directory(tmp_path):
+    directory = tmp_path / "coalesce"
+    directory.mkdir(mode=0o777)
+    directory.chmod(0o777)
+
+    with pytest.raises(PermissionError):
+        FileSingleFlight(str(directory)).do("a", lambda: b"result")
@@ -0,0 +1,58 @@
+import sqlite3
+import threading
+
+from app.database import ConnectionManager, open_database
+from app.monitoring import SCHEMA_VERSION
+
+
+def tables(db: sqlite3.Connection) -> set[str]:
+    rows = db.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    return {name for (name,) in rows}
+
+
+def test_new_database(tmp_path):
+    db = open_database(str(tmp_path / "bettercal.db"))
+
+    assert {"statistics_daily", "statistics_rollup"} <= tables(db)
+    assert db.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert db.execute("PRAGMA busy_timeout").fetchone()[0] > 0
+
+
+def test_migrate_legacy_statistics(tmp_path):
+    path = str(tmp_path / "bettercal.db")
+    legacy = sqlite3.connect(path)
+    legacy.execute("CREATE TABLE statistics (date TEXT, token_hash TEXT)")
+    legacy.executemany(
+        "INSERT INTO statistics VALUES (?, ?)",
+        [
+            ("2023-07-01 10:00:00", "a"),
+            ("2023-07-01 18:00:00", "a"),
+            ("2023-07-02 10:00:00", "a"),
+        ],
+    )
+    legacy.commit()
+    legacy.close()
+
+    db = open_database(path)
+    rows = db.execute("SELECT date, token_hash FROM statistics_daily ORDER BY date")
+    assert rows.fetchall() == [("2023-07-01", "a"), ("2023-07-02", "a")]
+
+    # Opening it again doesn't migrate again
+    db.execute("DELETE FROM statistics_daily")
+    db.commit()
+    db = open_database(path)
+    assert db.execute("SELECT COUNT(*) FROM statistics_daily").fetchone() == (0,)
+
+
+def test_connection_per_thread(tmp_path):
+    connections = ConnectionManager(lambda: open_database(str(tmp_path / "db")))
+    first = connections.get()
+    assert connections.get() is first
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(connections.get()))
+    thread.start()
+    thread.join()
+    assert other[0] is not first
+    assert connections.opened == 2
@@ -0,0 +1,113 @@
+import pytest
+from icalendar import Calendar
+
+import app.format as format
+import app.pipeline as pipeline
+from app.cache import LRUCache
+from app.fastpath import rewrite_calendar
+from app.format import summary_regex
+from app.pipeline import CalendarOptions
+from tests.test_request import get_test_upstream
+
+
+@pytest.mark.parametrize("lang", ["de", "en"])
+@pytest.mark.parametrize(
+    "variant,options",
+    [
+        ("", {}),
+        ("forgoogle_", {"google_cal": True}),
+        ("noshorthands_", {"use_shorthand": False}),
+    ],
+)
+def test_fastpath_matches_snapshots(lang: str, variant: str, options: dict):
+    with open(f"tests/calendar_{lang}.ics") as f:
+        body = f.read()
+    with open(
+        f"tests/__snapshots__/test_request/test_icalendar_{variant}{lang}_success.ical",
+        "rb",
+    ) as f:
+        snapshot = f.read()
+
+    output = b"".join(rewrite_calendar(body, locale=lang, **options))
+
+    # The fast path doesn't reorder properties like icalendar does, but the
+    # content must be the same.
+    assert Calendar.from_ical(output).to_ical() == snapshot
+
+
+def test_fastpath_passes_lines_through():
+    with open("tests/calendar_en.ics", newline="") as f:
+        body = f.read()
+
+    chunks = rewrite_calendar(body, locale="en")
+    timezone = body[body.index("BEGIN:VTIMEZONE") : body.index("BEGIN:VEVENT")]
+
+    assert chunks[1].decode() == timezone
+
+
+def test_fastpath_falls_back_to_parser(mocker):
+    mocker.patch.object(pipeline, "_rendered_cache", LRUCache(8))
+    mocker.patch("app.pipeline.rewrite_calendar", side_effect=ValueError)
+    upstream = get_test_upstream(lang="en")
+    options = CalendarOptions(locale="en", google_cal=False, use_shorthand=True)
+
+    rendered = pipeline.render_calendar(upstream, options)
+
+    with open(
+        "tests/__snapshots__/test_request/test_icalendar_en_success.ical", "rb"
+    ) as f:
+        assert rendered.body == f.read()
+
+
+def test_repeating_lectures_enriched_once(mocker):
+    mocker.patch.object(format, "_fragment_cache", LRUCache(1024))
+    with open("tests/calendar_de.ics") as f:
+        body = f.read()
+    calendar = Calendar.from_ical(body)
+    distinct = {
+        (event.get("summary"), event.get("location"), event.get("description"))
+        for event in calendar.walk("VEVENT")
+        if summary_regex.match(event.get("summary"))
+    }
+
+    spy = mocker.spy(format, "enrich_event")
+    rewrite_calendar(body, locale="de")
+    assert spy.call_count == len(distinct)
+
+    # Other calendars with the same lectures are served from the cache
+    format.improve_calendar(calendar, locale="de")
+    assert spy.call_count == len(distinct)
+    assert format.get_fragment_statistics().size == len(distinct)
+
+    rewrite_calendar(body, locale="en")
+    assert spy.call_count == 2 * len(distinct)
+
+
+def test_fragment_cache_cleared_on_new_resources(mocker):
+    mocker.patch.object(format, "_fragment_cache", LRUCache(1024))
+    with open("tests/calendar_de.ics") as f:
+        body = f.read()
+
+    rewrite_calendar(body, locale="de")
+    assert format.get_fragment_statistics().size > 0
+
+    mocker.patch.object(format, "resource_version", return_value="new")
+    spy = mocker.spy(format, "enrich_event")
+    rewrite_calendar(body, locale="de")
+    assert spy.call_count == format.get_fragment_statistics().size
+
+
+def test_signup_events_prepared_once(mocker):
+    mocker.patch.object(format, "_signup_cache", LRUCache(1024))
+    with open("tests/calendar_en.ics") as f:
+        body = f.read()
+
+    spy = mocker.spy(format, "create_signup_events")
+    first = rewrite_calendar(body, locale="en")
+    courses = spy.call_count
+    assert courses > 0
+
+    # Another calendar with the same courses reuses them
+    assert rewrite_calendar(body, locale="en") == first
+    format.improve_calendar(Calendar.from_ical(body), locale="en")
+    assert spy.call_count == courses
@@ -0,0 +1,50 @@
+import pytest
+
+from app.metrics import Metrics, to_prometheus
+
+
+def test_histogram():
+    metrics = Metrics()
+    for value in [0.002, 0.03, 7]:
+        metrics.observe("bettercal_stage_seconds", value, (("stage", "fetch"),))
+    metrics.inc("bettercal_upstream_errors_total", (("type", "Timeout"),))
+
+    text = to_prometheus(metrics.samples())
+    assert "# TYPE bettercal_stage_seconds histogram" in text
+    # Buckets are cumulative and every one of them is exported
+    assert 'bettercal_stage_seconds_bucket{stage="fetch",le="0.0005"} 0' in text
+    assert 'bettercal_stage_seconds_bucket{stage="fetch",le="0.05"} 2' in text
+    assert 'bettercal_stage_seconds_bucket{stage="fetch",le="+Inf"} 3' in text
+    assert 'bettercal_stage_seconds_count{stage="fetch"} 3' in text
+    assert 'bettercal_upstream_errors_total{type="Timeout"} 1' in text
+
+    lines = [line for line in text.splitlines() if "_bucket" in line]
+    assert lines[-1].startswith(
+        'bettercal_stage_seconds_bucket{stage="fetch",le="+Inf"}'
+    )
+
+
+def test_collect_across_processes(tmp_path):
+    first = Metrics(str(tmp_path))
+    second = Metrics(str(tmp_path))
+
+    first.inc("bettercal_upstream_errors_total", (("type", "Timeout"),))
+    second.inc("bettercal_upstream_errors_total", (("type", "Timeout"),), 2)
+    second.write()
+
+    samples = first.collect()
+    assert samples == [
+        ("bettercal_upstream_errors_total", (("type", "Timeout"),), 3),
+    ]
+
+
+@pytest.mark.parametrize("value", ['a"b', "a\\b", "a\nb"])
+def test_label_escaping(value):
+    metrics = Metrics()
+    metrics.inc("bettercal_upstream_errors_total", (("type", value),))
+
+    [line] = [
+        line for line in to_prometheus(metrics.samples()).splitlines() if "{" in line
+    ]
+    assert "\n" not in line
+    assert line.endswith("} 1")
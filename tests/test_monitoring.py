@@ -0,0 +1,229 @@
+import random
+import sqlite3
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+import app.monitoring as monitoring
+from app.cache import LRUCache
+from app.monitoring import (
+    SCHEMA,
+    UsageRecorder,
+    downsample,
+    get_chart_data,
+    get_chart_data_exact,
+    get_chart_data_since,
+    get_statistics,
+    update_rollup,
+    update_sketch_rollup,
+)
+
+
+@pytest.fixture(autouse=True)
+def open_day_cache(monkeypatch):
+    cache = LRUCache(8, monitoring.OPEN_DAY_TTL)
+    monkeypatch.setattr(monitoring, "_open_day_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def connect(tmp_path):
+    path = tmp_path / "bettercal.db"
+
+    def connect():
+        db = sqlite3.connect(path)
+        db.executescript(SCHEMA)
+        return db
+
+    return connect
+
+
+def count_rows(connect) -> int:
+    db = connect()
+    try:
+        return db.execute("SELECT COUNT(*) FROM statistics_daily").fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_usage_recorder_batches(connect):
+    recorder = UsageRecorder(connect, interval=3600)
+    for token in ["a", "b", "a", "c", "a"]:
+        recorder.record(token)
+
+    assert count_rows(connect) == 0
+    assert recorder.statistics().pending == 3
+
+    recorder.flush()
+    assert count_rows(connect) == 3
+
+    # Users already written today are dropped before the database
+    recorder.record("b")
+    recorder.flush()
+    stats = recorder.statistics()
+    assert stats.recorded == 6
+    assert stats.duplicates == 3
+    assert stats.written == 3
+    assert stats.flushes == 1
+    assert stats.pending == 0
+
+
+def test_usage_recorder_other_processes(connect):
+    first = UsageRecorder(connect, interval=3600)
+    second = UsageRecorder(connect, interval=3600)
+    first.record("a")
+    second.record("a")
+    first.flush()
+    second.flush()
+
+    assert count_rows(connect) == 1
+    assert second.statistics().ignored_by_db == 1
+
+
+def test_usage_recorder_flushes_when_full(connect):
+    recorder = UsageRecorder(connect, interval=3600, max_pending=2)
+    recorder.record("a")
+    recorder.record("b")
+
+    # The flusher wakes up right away instead of after the interval
+    for _ in range(500):
+        if recorder.statistics().flushes > 0:
+            break
+        time.sleep(0.01)
+    assert count_rows(connect) == 2
+
+
+def test_usage_recorder_retries_failed_flush(connect):
+    broken = True
+
+    def flaky_connect():
+        if broken:
+            raise sqlite3.OperationalError("database is locked")
+        return connect()
+
+    recorder = UsageRecorder(flaky_connect, interval=3600)
+    recorder.record("a")
+    recorder.flush()
+    assert recorder.statistics().failed_flushes == 1
+    assert recorder.statistics().pending == 1
+
+    broken = False
+    recorder.flush()
+    assert count_rows(connect) == 1
+
+
+def add_history(db, days: int, users: int, seed: int = 0):
+    """Random usage for the days up to and including today."""
+
+    rng = random.Random(seed)
+    today = datetime.now(UTC).date()
+    rows = [
+        ((today - timedelta(days=day)).isoformat(), f"user{user}")
+        for day in range(days)
+        for user in rng.sample(range(users), rng.randint(0, users // 2))
+    ]
+    db.executemany(
+        "INSERT INTO statistics_daily (date, token_hash) VALUES (?, ?)", rows
+    )
+    db.commit()
+
+
+def test_rollup_matches_exact(connect, open_day_cache):
+    db = connect()
+    add_history(db, days=90, users=40)
+
+    assert get_chart_data(db) == get_chart_data_exact(db)
+    # Only the days that are over end up in the rollup
+    rolled = db.execute("SELECT MAX(date) FROM statistics_rollup").fetchone()[0]
+    assert rolled < datetime.now(UTC).date().isoformat()
+
+    # The rollup is read from now on, and new usage still shows up
+    db.execute("INSERT INTO statistics_daily (token_hash) VALUES ('newcomer')")
+    db.commit()
+    assert get_chart_data(db) != get_chart_data_exact(db)
+    # Today's statistics are cached for a short while
+    open_day_cache.clear()
+    assert get_chart_data(db) == get_chart_data_exact(db)
+
+    since = (datetime.now(UTC).date() - timedelta(days=10)).isoformat()
+    assert get_chart_data_since(db, since) == get_chart_data_exact(db, since)
+
+    _, daily, monthly, total = get_chart_data_exact(db)[-1]
+    statistic = get_statistics(db)
+    assert (statistic.daily_users, statistic.monthly_users, statistic.total_users) == (
+        daily,
+        monthly,
+        total,
+    )
+
+
+def test_rollup_is_incremental(connect):
+    db = connect()
+    add_history(db, days=20, users=10)
+    get_chart_data(db)
+    rows = db.execute("SELECT * FROM statistics_rollup").fetchall()
+
+    # Another worker updating it at the same time doesn't add anything
+    get_chart_data(connect())
+    assert db.execute("SELECT * FROM statistics_rollup").fetchall() == rows
+
+
+@pytest.mark.parametrize("update", [update_rollup, update_sketch_rollup])
+def test_concurrent_rollups(connect, update):
+    add_history(connect(), days=300, users=200)
+
+    errors = []
+
+    def roll_up():
+        try:
+            update(connect())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=roll_up) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    db = connect()
+    assert get_chart_data(db) == get_chart_data_exact(db)
+
+
+def test_approximate_users(connect, monkeypatch):
+    db = connect()
+    add_history(db, days=60, users=2000)
+
+    exact = get_chart_data_exact(db)
+    approximate = get_chart_data_since(db, approximate=True)
+    assert [row[:2] for row in approximate] == [row[:2] for row in exact]
+    for (_, _, monthly, total), (_, _, estimated_monthly, estimated_total) in zip(
+        exact, approximate, strict=True
+    ):
+        assert estimated_monthly == pytest.approx(monthly, rel=0.05)
+        assert estimated_total == pytest.approx(total, rel=0.05)
+
+    monkeypatch.setattr(monitoring, "APPROXIMATE_USERS", True)
+    assert get_statistics(db).total_users == pytest.approx(exact[-1][3], rel=0.05)
+
+
+def test_downsample():
+    rows = [
+        ("2024-01-29", 10, 100, 1000),
+        ("2024-01-31", 20, 110, 1010),
+        ("2024-02-01", 30, 120, 1020),
+        ("2024-02-05", 41, 130, 1030),
+    ]
+
+    assert downsample(rows, "day") == rows
+    assert downsample(rows, "week") == [
+        ("2024-01-29", 20, 120, 1020),
+        ("2024-02-05", 41, 130, 1030),
+    ]
+    assert downsample(rows, "month") == [
+        ("2024-01-01", 15, 110, 1010),
+        ("2024-02-01", 36, 130, 1030),
+    ]
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from app.registry import ResourceRegistry
+
+
+def test_reload_when_files_change(tmp_path):
+    path = tmp_path / "courses.csv"
+    path.write_text("first")
+    registry = ResourceRegistry([str(path)], path.read_text, interval=None)
+
+    assert registry.get() == "first"
+    assert not registry.reload_if_changed()
+
+    path.write_text("second version")
+    assert registry.reload_if_changed()
+    assert registry.get() == "second version"
+    assert registry.reloads == 1
+
+
+def test_replaced_file(tmp_path):
+    path = tmp_path / "courses.csv"
+    path.write_text("first")
+    registry = ResourceRegistry([str(path)], path.read_text, interval=None)
+    registry.get()
+
+    # Same size and maybe even the same mtime, but another file
+    (tmp_path / "new.csv").write_text("other")
+    os.replace(tmp_path / "new.csv", path)
+    assert registry.reload_if_changed()
+    assert registry.get() == "other"
+
+
+def test_pinned_version(tmp_path):
+    path = tmp_path / "courses.csv"
+    path.write_text("first")
+    registry = ResourceRegistry([str(path)], path.read_text, interval=None)
+
+    with registry.pinned() as pinned:
+        assert pinned == "first"
+        path.write_text("second version")
+        registry.reload_if_changed()
+        # Everything in here still sees the version it started with
+        assert registry.get() == "first"
+
+    assert registry.get() == "second version"
+
+
+def test_failed_reload_keeps_old_version(tmp_path):
+    path = tmp_path / "courses.csv"
+    path.write_text("first")
+
+    def load():
+        if path.read_text() != "first":
+            raise ValueError("Broken csv")
+        return "first"
+
+    registry = ResourceRegistry([str(path)], load, interval=None)
+    registry.get()
+    path.write_text("broken")
+    with pytest.raises(ValueError):
+        registry.reload_if_changed()
+    assert registry.get() == "first"
+
+
+def test_unwatched(tmp_path):
+    path = tmp_path / "courses.csv"
+    path.write_text("first")
+    registry = ResourceRegistry([str(path)], path.read_text, interval=30)
+
+    with registry.unwatched():
+        assert registry.get() == "first"
+        assert registry._watcher is None
+
+    registry.get()
+    assert registry._watcher is not None
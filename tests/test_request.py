@@ -1,13 +1,28 @@
+import hashlib
+import json
+import time
+from dataclasses import replace
+
+import pytest
+import requests
 from flask.testing import FlaskClient
 from icalendar import Calendar, Component
 
+from app.monitoring import OPEN_DAY_TTL
+from app.tiss import UpstreamCalendar
+
 
-def get_test_calendar(lang: str = "de"):
+def get_test_upstream(lang: str = "de") -> UpstreamCalendar:
     # FIXME: we need better examples, at the moment they only have 5 events and
     # we could even merge multiple into one.
     with open(f"tests/calendar_{lang}.ics") as f:
-        cal = Calendar.from_ical(f.read())
-    return cal
+        body = f.read()
+    return UpstreamCalendar(
+        body=body,
+        digest=hashlib.sha256(body.encode()).hexdigest(),
+        etag=None,
+        last_modified=None,
+    )
 
 
 def calendar_event_cnt(cal: Component) -> int:
@@ -30,21 +45,21 @@ def test_home_page(client: FlaskClient):
 
 
 def test_verify_bad_url(client: FlaskClient, mocker):
-    mocker.patch("app.tiss.get_calendar", return_value=None)
+    mocker.patch("app.tiss.fetch_calendar", return_value=None)
 
     response = client.get("/verify?url=nooAUrl")
     assert response.status_code == 400
 
 
 def test_verify_not_tiss_url(client: FlaskClient, mocker):
-    mocker.patch("app.tiss.get_calendar", return_value=get_test_calendar())
+    mocker.patch("app.tiss.fetch_calendar", return_value=get_test_upstream())
 
     response = client.get("/verify?url=https://example.com")
     assert response.status_code == 400
 
 
 def test_verify_success(client: FlaskClient, mocker):
-    mocker.patch("app.tiss.get_calendar", return_value=get_test_calendar())
+    mocker.patch("app.tiss.fetch_calendar", return_value=get_test_upstream())
 
     response = client.get(
         "/verify?url=https://tiss.tuwien.ac.at/events/rest/calendar/personal?locale=de%26token=justATestingTokenObviouslyNotReal"
@@ -52,9 +67,10 @@ def test_verify_success(client: FlaskClient, mocker):
     assert response.status_code == 200
 
 
+@pytest.mark.usefixtures("full_parser")
 def test_icalendar_de_success(client: FlaskClient, mocker, snapshot_ical):
-    testcal = get_test_calendar(lang="de")
-    mocker.patch("app.tiss.get_calendar", return_value=testcal)
+    upstream = get_test_upstream(lang="de")
+    mocker.patch("app.tiss.fetch_calendar", return_value=upstream)
 
     response = client.get(
         "/personal.ics?locale=de&token=justATestingTokenObviouslyNotReal"
@@ -67,9 +83,10 @@ def test_icalendar_de_success(client: FlaskClient, mocker, snapshot_ical):
     assert snapshot_ical == response.text
 
 
+@pytest.mark.usefixtures("full_parser")
 def test_icalendar_en_success(client: FlaskClient, mocker, snapshot_ical):
-    testcal = get_test_calendar(lang="en")
-    mocker.patch("app.tiss.get_calendar", return_value=testcal)
+    upstream = get_test_upstream(lang="en")
+    mocker.patch("app.tiss.fetch_calendar", return_value=upstream)
 
     response = client.get(
         "/personal.ics?locale=en&token=justATestingTokenObviouslyNotReal"
@@ -82,9 +99,10 @@ def test_icalendar_en_success(client: FlaskClient, mocker, snapshot_ical):
     assert snapshot_ical == response.text
 
 
+@pytest.mark.usefixtures("full_parser")
 def test_icalendar_forgoogle_de_success(client: FlaskClient, mocker, snapshot_ical):
-    testcal = get_test_calendar(lang="de")
-    mocker.patch("app.tiss.get_calendar", return_value=testcal)
+    upstream = get_test_upstream(lang="de")
+    mocker.patch("app.tiss.fetch_calendar", return_value=upstream)
 
     response = client.get(
         "/personal.ics?locale=de&token=justATestingTokenObviouslyNotReal&google"
@@ -97,9 +115,10 @@ def test_icalendar_forgoogle_de_success(client: FlaskClient, mocker, snapshot_ic
     assert snapshot_ical == response.text
 
 
+@pytest.mark.usefixtures("full_parser")
 def test_icalendar_forgoogle_en_success(client: FlaskClient, mocker, snapshot_ical):
-    testcal = get_test_calendar(lang="en")
-    mocker.patch("app.tiss.get_calendar", return_value=testcal)
+    upstream = get_test_upstream(lang="en")
+    mocker.patch("app.tiss.fetch_calendar", return_value=upstream)
 
     response = client.get(
         "/personal.ics?locale=en&token=justATestingTokenObviouslyNotReal&google"
@@ -112,9 +131,10 @@ def test_icalendar_forgoogle_en_success(client: FlaskClient, mocker, snapshot_ic
     assert snapshot_ical == response.text
 
 
+@pytest.mark.usefixtures("full_parser")
 def test_icalendar_noshorthands_de_success(client: FlaskClient, mocker, snapshot_ical):
-    testcal = get_test_calendar(lang="de")
-    mocker.patch("app.tiss.get_calendar", return_value=testcal)
+    upstream = get_test_upstream(lang="de")
+    mocker.patch("app.tiss.fetch_calendar", return_value=upstream)
 
     response = client.get(
         "/personal.ics?locale=de&token=justATestingTokenObviouslyNotReal&noshorthand"
@@ -127,9 +147,10 @@ def test_icalendar_noshorthands_de_success(client: FlaskClient, mocker, snapshot
     assert snapshot_ical == response.text
 
 
+@pytest.mark.usefixtures("full_parser")
 def test_icalendar_noshorthands_en_success(client: FlaskClient, mocker, snapshot_ical):
-    testcal = get_test_calendar(lang="en")
-    mocker.patch("app.tiss.get_calendar", return_value=testcal)
+    upstream = get_test_upstream(lang="en")
+    mocker.patch("app.tiss.fetch_calendar", return_value=upstream)
 
     response = client.get(
         "/personal.ics?locale=en&token=justATestingTokenObviouslyNotReal&noshorthand"
@@ -140,3 +161,184 @@ def test_icalendar_noshorthands_en_success(client: FlaskClient, mocker, snapshot
     Calendar.from_ical(response.data)
 
     assert snapshot_ical == response.text
+
+
+@pytest.mark.parametrize("lang", ["de", "en"])
+def test_icalendar_fast_path(client: FlaskClient, mocker, lang: str):
+    mocker.patch("app.tiss.fetch_calendar", return_value=get_test_upstream(lang))
+
+    response = client.get(
+        f"/personal.ics?locale={lang}&token=justATestingTokenObviouslyNotReal"
+    )
+    assert response.status_code == 200
+
+    # Only the order of the properties differs from the full parser
+    with open(
+        f"tests/__snapshots__/test_request/test_icalendar_{lang}_success.ical", "rb"
+    ) as f:
+        assert Calendar.from_ical(response.data).to_ical() == f.read()
+
+
+def test_pool_statistics(client: FlaskClient):
+    response = client.get("/statistics/pool")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data is not None
+    assert 0 <= data["reuse_rate"] <= 1
+
+
+def test_fragment_statistics(client: FlaskClient):
+    response = client.get("/statistics/fragments")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data is not None
+    assert data["size"] <= data["maxsize"]
+
+
+def test_statistics_page_revalidates(client: FlaskClient):
+    response = client.get("/statistics")
+    assert response.status_code == 200
+    assert response.cache_control.max_age == OPEN_DAY_TTL
+    etag, _ = response.get_etag()
+
+    response = client.get("/statistics", headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 304
+    assert response.get_etag()[0] == etag
+
+
+def test_chart_statistics(client: FlaskClient):
+    response = client.get("/statistics/chart?since=2024-01-31&resolution=week")
+    assert response.status_code == 200
+    assert response.json == []
+    assert response.get_etag()[0] is not None
+
+    assert client.get("/statistics/chart?since=yesterday").status_code == 400
+    assert client.get("/statistics/chart?resolution=year").status_code == 400
+
+
+def test_metrics(client: FlaskClient, mocker):
+    mocker.patch("app.tiss.fetch_calendar", return_value=get_test_upstream())
+    client.get("/personal.ics?locale=de&token=justATestingTokenObviouslyNotReal")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    assert 'bettercal_stage_seconds_count{stage="calendar"}' in response.text
+    assert 'bettercal_stage_seconds_count{stage="record_usage"}' in response.text
+    assert "bettercal_response_bytes_count" in response.text
+    assert 'bettercal_cache_hits_total{cache="rendered"}' in response.text
+
+
+def test_slow_request_log(app, client: FlaskClient, mocker, monkeypatch, caplog):
+    upstream = get_test_upstream()
+    mocker.patch("app.tiss.fetch_calendar", return_value=upstream)
+    monkeypatch.setitem(app.config, "SLOW_REQUEST_THRESHOLD", 0)
+
+    token = "justATestingTokenObviouslyNotReal"
+    client.get(
+        f"/personal.ics?locale=de&token={token}&google",
+        headers={"X-Request-ID": "abc"},
+    )
+
+    [message] = [
+        r.getMessage() for r in caplog.records if "slow request" in r.getMessage()
+    ]
+    assert token not in message
+    record = json.loads(message.removeprefix("slow request "))
+    assert record["request_id"] == "abc"
+    assert record["token_hash"] == hashlib.sha256(token.encode()).hexdigest()
+    assert record["google"] and record["shorthand"]
+    assert record["upstream_bytes"] == len(upstream.body.encode())
+    assert record["events"] > 0
+    assert {"calendar", "record_usage"} <= record["stages"].keys()
+
+    # Served from the render cache, it still has the events
+    client.get(f"/personal.ics?locale=de&token={token}&google")
+    cached = slow_requests(caplog)[-1]
+    assert cached["cached"] and cached["events"] == record["events"]
+
+
+def slow_requests(caplog) -> list[dict]:
+    messages = [r.getMessage() for r in caplog.records]
+    return [
+        json.loads(m.removeprefix("slow request "))
+        for m in messages
+        if m.startswith("slow request ")
+    ]
+
+
+def test_slow_request_log_without_response_object(
+    app, client: FlaskClient, monkeypatch, caplog
+):
+    monkeypatch.setitem(app.config, "SLOW_REQUEST_THRESHOLD", 0)
+
+    # The view returns a tuple here
+    response = client.get("/personal.ics?locale=de")
+    assert response.status_code == 400
+    [record] = slow_requests(caplog)
+    assert record["status"] == 400
+    assert record["error"] is None
+    assert record["token_hash"] is None
+
+
+def test_slow_request_log_failed_request(
+    app, client: FlaskClient, mocker, monkeypatch, caplog
+):
+    mocker.patch("app.tiss.fetch_calendar", side_effect=requests.Timeout())
+    monkeypatch.setitem(app.config, "SLOW_REQUEST_THRESHOLD", 0)
+
+    with pytest.raises(requests.Timeout):
+        client.get("/personal.ics?locale=de&token=aSlowToken")
+    [record] = slow_requests(caplog)
+    assert record["status"] == 500
+    assert record["error"] == "Timeout"
+    assert "calendar" in record["stages"]
+
+
+def test_icalendar_not_modified(client: FlaskClient, mocker):
+    upstream = get_test_upstream(lang="en")
+    mocker.patch("app.tiss.fetch_calendar", return_value=upstream)
+
+    url = "/personal.ics?locale=en&token=justATestingTokenObviouslyNotReal"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["ETag"]
+
+    response = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_icalendar_stale_while_revalidate(app, client: FlaskClient, mocker):
+    mocker.patch.dict(app.config, {"CALENDAR_MAX_STALENESS": 60})
+    mocker.patch("app.pipeline.REFRESH_AFTER", 0)
+    refresh = mocker.patch("app.pipeline._refresh_in_background")
+    fetch = mocker.patch(
+        "app.tiss.fetch_calendar", return_value=get_test_upstream(lang="de")
+    )
+
+    url = "/personal.ics?locale=de&token=staleWhileRevalidateToken"
+    first = client.get(url)
+    fetch.side_effect = TimeoutError
+    second = client.get(url)
+
+    assert second.status_code == 200
+    assert first.data == second.data
+    assert fetch.call_count == 1
+    refresh.assert_called_once()
+
+
+def test_icalendar_staleness_counts_from_upstream_fetch(
+    app, client: FlaskClient, mocker
+):
+    mocker.patch.dict(app.config, {"CALENDAR_MAX_STALENESS": 60})
+    # TISS sent it two minutes ago, our upstream cache kept it since then
+    upstream = replace(get_test_upstream(lang="de"), fetched_at=time.time() - 120)
+    fetch = mocker.patch("app.tiss.fetch_calendar", return_value=upstream)
+
+    url = "/personal.ics?locale=de&token=oldUpstreamToken"
+    client.get(url)
+    client.get(url)
+
+    # Too old to be served without asking for it again
+    assert fetch.call_count == 2
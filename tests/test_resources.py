@@ -0,0 +1,92 @@
+import pytest
+
+import app.format as format
+
+
+@pytest.fixture
+def bundle_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "bundle.pickle")
+    monkeypatch.setattr(format, "BUNDLE_FILE", path)
+    return path
+
+
+def test_missing_bundle(bundle_file):
+    assert format.read_bundle(format.compute_resource_version()) is None
+
+
+def test_compiled_bundle(bundle_file):
+    format.compile_resources(bundle_file)
+    bundle = format.read_bundle(format.compute_resource_version())
+
+    assert bundle is not None
+    assert bundle.courses == format.parse_courses()
+    assert bundle.shorthands == format.parse_shorthands()
+    assert bundle.lecturetube_available_rooms == (
+        format.parse_lecturetube_available_rooms()
+    )
+
+    def flatten(rooms):
+        return {
+            name: (address, floor.de, floor.en, code, url)
+            for name, (address, floor, code, url) in rooms.items()
+        }
+
+    assert flatten(bundle.rooms) == flatten(format.parse_rooms())
+
+
+def test_outdated_bundle(bundle_file):
+    format.compile_resources(bundle_file)
+
+    assert format.read_bundle("outdated") is None
+
+
+def course(name: str) -> format.Course:
+    return format.Course(None, name, "", None, None, None, None)
+
+
+def test_shorthand_index():
+    index = format.read_shorthand_index()
+
+    assert index["Propädeutikum für Informatik"] == "PROLOG"
+    assert format.create_shorthand("Propädeutikum für Informatik") == "PROLOG"
+    # Curated names don't need to match the case
+    assert format.create_shorthand("Programming paradigms") == "PROGPAR"
+    # Names that are not in courses.csv still get a shorthand
+    assert "Some Made Up Lecture" not in index
+    assert format.create_shorthand("Some Made Up Lecture") == "SMUL"
+
+
+def test_shorthand_report():
+    courses = {
+        "1": course("Advanced Cryptography"),
+        "2": course("Applied Cartography"),
+        "3": course("Programming Paradigms"),
+        "4": course("Programming Paradigms Exercises"),
+        "5": course("Mathematik"),
+    }
+    shorthands = {"programming paradigms": "progpar"}
+
+    report = format.create_shorthand_report(courses, shorthands)
+    assert report.collisions == {
+        "AC": {"Advanced Cryptography", "Applied Cartography"},
+    }
+    assert report.invalid == {"Mathematik"}
+
+
+def test_room_records():
+    event = format.Event(
+        name="Programming Languages",
+        lecture_type="VU",
+        number="185.208",
+        description="Lecture",
+        room="  ei 5 HOCHENEGG  hs",
+        tiss_url="",
+    )
+    event = format.add_location(event)
+
+    assert event.room == "EI 5 Hochenegg HS"
+    assert event.room_record is format.read_room_records()["EI 5 Hochenegg HS"]
+    assert event.room_code == "CF0229"
+    assert event.lecturetube_url is not None
+    assert "Raum:<br><a href=" in event.html_description("de")
+    assert "Room:\nEI 5 Hochenegg HS" in event.plain_description("en")
@@ -0,0 +1,26 @@
+import pytest
+
+from app.sketch import HyperLogLog, merge_all
+
+
+@pytest.mark.parametrize("users", [0, 1, 100, 5_000, 100_000])
+def test_count(users):
+    sketch = HyperLogLog.of(f"user{user}" for user in range(users))
+    assert sketch.count() == pytest.approx(users, rel=0.05, abs=1)
+
+
+def test_merge_is_union():
+    first = HyperLogLog.of(f"user{user}" for user in range(0, 3000))
+    second = HyperLogLog.of(f"user{user}" for user in range(2000, 5000))
+
+    merged = merge_all([first, second])
+    assert merged.count() == pytest.approx(5000, rel=0.05)
+    # Adding the same users again changes nothing
+    assert merge_all([merged, first]).registers == merged.registers
+
+
+def test_round_trip():
+    sketch = HyperLogLog.of(["a", "b", "c"])
+    assert HyperLogLog(sketch.to_bytes()).registers == sketch.registers
+    with pytest.raises(ValueError):
+        HyperLogLog(b"too short")
@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import icalendar
+
+from app.fastpath import rewrite_calendar
+from app.format import iter_ical
+from app.timezones import read_timezones, replace_timezones, serialized_timezone
+
+
+def get_test_chunks(lang: str) -> list[bytes]:
+    with open(f"tests/calendar_{lang}.ics", newline="") as f:
+        return rewrite_calendar(f.read(), locale=lang)
+
+
+def test_replace_known_timezone():
+    chunks = get_test_chunks("en")
+    replaced = replace_timezones(chunks)
+
+    assert len(replaced) == len(chunks)
+    assert serialized_timezone("Europe/Vienna") in replaced
+    # Parsing and serializing our copy doesn't change the timezone
+    original = icalendar.Calendar.from_ical(b"".join(chunks))
+    assert original.walk("VTIMEZONE")[0].to_ical() == serialized_timezone(
+        "Europe/Vienna"
+    )
+
+
+def test_iter_ical_reuses_serialized_timezones():
+    with open("tests/calendar_de.ics") as f:
+        cal = icalendar.Calendar.from_ical(f.read())
+
+    assert list(iter_ical(cal, serialized_timezone)) == list(iter_ical(cal))
+
+
+def test_unknown_timezone_unchanged():
+    chunks = [
+        b"BEGIN:VCALENDAR\r\n",
+        b"BEGIN:VTIMEZONE\r\nTZID:Mars/Olympus_Mons\r\nEND:VTIMEZONE\r\n",
+        b"END:VCALENDAR\r\n",
+    ]
+    assert replace_timezones(chunks, compact=True) == chunks
+
+
+def test_compact_timezone():
+    chunks = get_test_chunks("de")
+    compact = replace_timezones(chunks, compact=True)
+    assert sum(map(len, compact)) < sum(map(len, chunks))
+
+    timezone = icalendar.Calendar.from_ical(b"".join(compact)).walk("VTIMEZONE")[0]
+    assert isinstance(timezone, icalendar.Timezone)
+    assert len(timezone.subcomponents) == 3
+
+    # All events still have the same offset
+    full = read_timezones()["Europe/Vienna"].to_tz()
+    trimmed = timezone.to_tz()
+    events = icalendar.Calendar.from_ical(b"".join(compact)).walk("VEVENT")
+    for event in events:
+        start = event["DTSTART"].dt
+        if not isinstance(start, datetime):
+            continue
+        start = start.replace(tzinfo=None)
+        assert full.utcoffset(start) == trimmed.utcoffset(start)
@@ -0,0 +1,42 @@
+import app.tiss as tiss
+from app.cache import LRUCache
+
+
+def mock_response(mocker, status_code: int = 200, headers: dict | None = None):
+    with open("tests/calendar_en.ics") as f:
+        body = f.read()
+
+    response = mocker.Mock()
+    response.status_code = status_code
+    response.text = body
+    response.headers = headers or {}
+    return response
+
+
+def test_calendar_is_cached(mocker):
+    mocker.patch.object(tiss, "_calendar_cache", LRUCache(8, 60))
+    session = mocker.patch("app.tiss.get_session").return_value
+    session.get.return_value = mock_response(mocker)
+
+    first = tiss.fetch_calendar("https://tiss.example/calendar")
+    second = tiss.fetch_calendar("https://tiss.example/calendar")
+
+    assert session.get.call_count == 1
+    assert second.calendar is first.calendar
+
+
+def test_calendar_is_revalidated(mocker):
+    mocker.patch.object(tiss, "_calendar_cache", LRUCache(8, 0))
+    session = mocker.patch("app.tiss.get_session").return_value
+    session.get.return_value = mock_response(mocker, headers={"ETag": '"v1"'})
+
+    first = tiss.fetch_calendar("https://tiss.example/calendar")
+    parsed = first.calendar
+    session.get.return_value = mock_response(mocker, status_code=304)
+    second = tiss.fetch_calendar("https://tiss.example/calendar")
+
+    assert session.get.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+    assert second.digest == first.digest
+    assert second.calendar is parsed
+    # TISS confirmed it just now
+    assert second.fetched_at >= first.fetched_at